@@ -0,0 +1,100 @@
+import os
+import random
+import statistics
+import time
+import rich_click as click
+
+from dotenv import load_dotenv, find_dotenv
+
+_HIDDEN_KEYS = ['gtype', 'bbox', 'month', 'year']
+
+# read-only shapes of the Neo4jClient queries, as interpolated f-strings (before) and parameterized (after).
+CASES = {
+    "query_topology_distance": (
+        lambda filename: (f"""
+        MATCH path = (start:Point {{filename: '{filename}'}})-[r:CONNECTED_TO*1..1]-(other)
+        RETURN [rel IN relationships(path) | properties(rel)] AS relationship_properties,
+            apoc.map.removeKeys(properties(start), ['gtype', 'bbox', 'month', 'year']) AS source_node,
+            apoc.map.removeKeys(properties(other), ['gtype', 'bbox', 'month', 'year']) AS target_node
+        """, {}),
+        lambda filename: ("""
+        MATCH path = (start:Point {filename: $filename})-[r:CONNECTED_TO*1..1]-(other:Point)
+        RETURN [rel IN relationships(path) | properties(rel)] AS relationship_properties,
+            apoc.map.removeKeys(properties(start), $hidden_keys) AS source_node,
+            apoc.map.removeKeys(properties(other), $hidden_keys) AS target_node
+        """, {"filename": filename, "hidden_keys": _HIDDEN_KEYS}),
+    ),
+    "query_spatial_distance": (
+        lambda filename: (f"""
+        MATCH (start:Point {{filename: '{filename}'}})
+        CALL spatial.withinDistance("locations", start, {100.0 / 1000}) YIELD node AS nearby_node
+        MATCH (nearby_node)-[r:CONNECTED_TO]->(other_nearby)
+        RETURN properties(r) AS relationship_properties,
+            apoc.map.removeKeys(properties(nearby_node), ['gtype', 'bbox', 'month', 'year']) AS source_node,
+            apoc.map.removeKeys(properties(other_nearby), ['gtype', 'bbox', 'month', 'year']) AS target_node
+        """, {}),
+        lambda filename: ("""
+        MATCH (start:Point {filename: $filename})
+        CALL spatial.withinDistance("locations", start, $distance_km) YIELD node AS nearby_node
+        MATCH (nearby_node:Point)-[r:CONNECTED_TO]->(other_nearby:Point)
+        RETURN properties(r) AS relationship_properties,
+            apoc.map.removeKeys(properties(nearby_node), $hidden_keys) AS source_node,
+            apoc.map.removeKeys(properties(other_nearby), $hidden_keys) AS target_node
+        """, {"filename": filename, "distance_km": 100.0 / 1000, "hidden_keys": _HIDDEN_KEYS}),
+    ),
+    # the match of set_node_round_success, without the write.
+    "set_node_round_success (match)": (
+        lambda filename: ("MATCH (n) WHERE n.round_1 IS NOT NULL RETURN count(n)", {}),
+        lambda filename: ("MATCH (n:Point) WHERE n[$key] IS NOT NULL RETURN count(n)", {"key": "round_1"}),
+    ),
+    "retrieve_viewpoint_from_filename": (
+        lambda filename: (f"MATCH (n {{filename: '{filename}'}}) RETURN n", {}),
+        lambda filename: ("MATCH (n:Point {filename: $filename}) RETURN n", {"filename": filename}),
+    ),
+}
+
+
+def time_query(client, query: str, params: dict) -> float:
+    start = time.perf_counter()
+    client.query(query, params=params)
+
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("-e", "--env", default=".env", type=click.Path(exists=True), help="Path to the .env file.")
+@click.option("-d", "--db", default="beijing1", type=click.STRING, help="database name in neo4j")
+@click.option("-n", "--repeat", default=50, type=click.INT, help="runs per query, each on another viewpoint.")
+@click.option("--schema/--no-schema", default=False, help="create the Point(filename) constraint before timing.")
+def main(env: str, db: str, repeat: int, schema: bool):
+    """
+    Median latency of the Neo4jClient queries before (interpolated) and after (parameterized, labelled).
+    """
+    load_dotenv(find_dotenv(env, raise_error_if_not_found=True), override=True)
+    from langchain_neo4j import Neo4jGraph
+
+    client = Neo4jGraph(url=os.getenv("NEO4J_URL"), username="neo4j", password=os.getenv("NEO4J_PASSWORD"),
+                        database=db)
+    if schema:
+        # same statement as Neo4jClient.ensure_schema, which always runs when a simulation starts.
+        client.query("CREATE CONSTRAINT point_filename_unique IF NOT EXISTS FOR (n:Point) REQUIRE n.filename IS UNIQUE")
+
+    filenames = [row["filename"] for row in client.query("MATCH (n:Point) RETURN n.filename AS filename")]
+    samples = random.Random(0).sample(filenames, min(repeat, len(filenames)))
+
+    click.echo(f"{'':<36}{'before':>12}{'after':>12}{'speedup':>10}")
+    for name, (before, after) in CASES.items():
+        try:
+            timings = [
+                [time_query(client, *build(filename)) for filename in samples] for build in (before, after)
+            ]
+        except Exception as e:
+            click.echo(f"{name:<36} skipped: {e}")
+            continue
+        medians = [statistics.median(timing) for timing in timings]
+        click.echo(f"{name:<36}{medians[0] * 1000:>10.2f}ms{medians[1] * 1000:>10.2f}ms"
+                   f"{medians[0] / medians[1]:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import statistics
+import tempfile
+import rich_click as click
+
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, ROOT.as_posix())
+
+
+def time_step(agent, num_images: int, cold: bool) -> float:
+    """
+    seconds spent rendering the stop-check and perspective prompts of one step, without the model call.
+    cold rebuilds the templates as every step used to.
+    """
+    params = {
+        "query": "I am hungry, where can I find a restaurant?",
+        "perspective_prompt": f"Here are {num_images} perspectives.",
+        "direction_prompt": {chr(65 + i): "This perspective is on your FRONT" for i in range(num_images)},
+        **{chr(65 + i): "data:image/jpeg;base64," + "A" * 1024 for i in range(num_images)},
+    }
+    start = time.perf_counter()
+    if cold:
+        agent._prompts.clear()
+    stop_prompt = agent._prompt(("stop",), agent._build_stop_prompt)
+    stop_prompt.invoke({"query": params["query"], "backtrack_prompt": "", "image_url": params["A"]}).to_messages()
+    choice_prompt = agent._prompt(("choice", num_images, False, False, False),
+                                  lambda: agent._build_choice_prompt(num_images))
+    choice_prompt.invoke(params).to_messages()
+
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("-n", "--repeat", default=200, type=click.INT, help="steps per perspective count, the median is reported.")
+def main(repeat: int):
+    """
+    Per-step python overhead of the prompts of a step, with templates rebuilt every step (cold) or compiled once.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        # utils.map_logger builds its logger at import time from these variables.
+        os.environ.update(STORE_JSON=f"{tmp}/bench.jsonl", CITY_NAME="bench", SECTION="bench", AGENT="bench",
+                          LOG_LEVEL="WARNING")
+        from src.mllm.registry import create_agent
+
+        agent = create_agent("StraightBaselineModel")
+        click.echo(f"{'perspectives':<14}{'cold':>12}{'compiled':>12}{'speedup':>10}")
+        for num_images in range(1, 9):
+            cold = statistics.median(time_step(agent, num_images, cold=True) for _ in range(repeat))
+            warm = statistics.median(time_step(agent, num_images, cold=False) for _ in range(repeat))
+            click.echo(f"{num_images:<14}{cold * 1000:>10.3f}ms{warm * 1000:>10.3f}ms{cold / warm:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
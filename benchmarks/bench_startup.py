@@ -0,0 +1,55 @@
+import os
+import sys
+import statistics
+import subprocess
+import tempfile
+import rich_click as click
+
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# each case runs in a fresh interpreter, so module caches do not hide the import cost.
+CASES = {
+    "registry: StraightBaselineModel": "from src.mllm.registry import resolve_agent; resolve_agent('StraightBaselineModel')",
+    "registry: RandomBaselineModel": "from src.mllm.registry import resolve_agent; resolve_agent('RandomBaselineModel')",
+    "registry: gpt_4o_mini": "from src.mllm.registry import resolve_agent; resolve_agent('gpt_4o_mini')",
+    "eager: every agent module": "import src.mllm.all_models, src.mllm.chatgpt, src.mllm.straight, src.mllm.random",
+    "src.map": "import src.map",
+}
+_TIMER = """
+import time
+_start = time.perf_counter()
+{statement}
+print(time.perf_counter() - _start)
+"""
+
+
+def time_statement(statement: str, env: dict) -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", _TIMER.format(statement=statement)],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+
+    return float(output.strip().splitlines()[-1])
+
+
+@click.command()
+@click.option("-n", "--repeat", default=5, type=click.INT, help="runs per case, the median is reported.")
+def main(repeat: int):
+    """
+    Measure the import time of the agent entry points, each in a fresh interpreter.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        # utils.map_logger builds its logger at import time from these variables.
+        env.update(STORE_JSON=f"{tmp}/bench.jsonl", CITY_NAME="bench", SECTION="bench", AGENT="bench",
+                   LOG_LEVEL="INFO")
+
+        for name, statement in CASES.items():
+            timings = [time_statement(statement, env) for _ in range(repeat)]
+            click.echo(f"{name:<36} median {statistics.median(timings):.3f}s  min {min(timings):.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import rich_click as click
+
+from pathlib import Path
+
+from utils.operation import convert_trajectories
+
+
+@click.command()
+@click.argument("jsonl", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("-o", "--out", default=None, type=click.Path(dir_okay=False),
+              help="output .json file, defaults to the input path with a .json suffix (single input only).")
+def main(jsonl: tuple, out: str):
+    """
+    Convert trajectory .jsonl outputs into the json array format read by downstream tools.
+    """
+    if out and len(jsonl) > 1:
+        raise click.BadParameter("--out can only be used with a single input file.")
+
+    for file in jsonl:
+        target = out or Path(file).with_suffix(".json").as_posix()
+        num = convert_trajectories(file, target)
+        click.echo(f"{file} -> {target} ({num} trajectories)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import os
+import json
+import rich_click as click
+
+from pathlib import Path
+from typing import Tuple
+from dotenv import load_dotenv, find_dotenv
+
+from utils.metrics import TrajectoryMetrics, METRICS
+from utils.operation import read_trajectories
+
+
+@click.command()
+@click.argument("trajectories", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("-g", "--gt", required=True, type=click.Path(exists=True), help="ground truth .json file.")
+@click.option("-d", "--db", default=None, type=click.STRING,
+              help="database name in neo4j, needed for SPD which is left empty otherwise.")
+@click.option("-e", "--env", default=".env", type=click.Path(), help="Path to the .env file, used with --db.")
+@click.option("-p", "--proximity", default=50.0, type=click.FLOAT, help="radius in meters counted as arrived by TCP, also the nDTW threshold.")
+@click.option("-b", "--by", "breakdowns", multiple=True, type=click.Choice(["city", "service", "category"]),
+              help="also report the metrics per city, service or question category.")
+@click.option("-o", "--out", default=None, type=click.Path(dir_okay=False), help="write the summaries to a .json file.")
+def main(trajectories: Tuple[str, ...], gt: str, db: str, env: str, proximity: float, breakdowns: Tuple[str, ...],
+         out: str):
+    """
+    Compute TCE, TCP, TCC, SPD and nDTW of simulation outputs (.jsonl or .json) against their ground truth.
+    """
+    snapshot = None
+    if db is not None:
+        load_dotenv(find_dotenv(env, raise_error_if_not_found=True), override=True)
+        os.environ["STORE_JSON"] = (Path("output_dir") / db / "evaluate" / "evaluate.jsonl").as_posix()
+        os.environ["CITY_NAME"] = db
+        os.environ["SECTION"] = "evaluate"
+        os.environ["AGENT"] = "evaluate"
+        os.environ["LOG_LEVEL"] = "INFO"
+        from utils.client import Neo4jClient
+
+        snapshot = Neo4jClient(db).topology
+
+    with open(gt, mode="r", encoding="utf-8") as f:
+        ground_truth = json.load(f)
+    outputs = [trajectory for file in trajectories for trajectory in read_trajectories(file)]
+
+    columns = TrajectoryMetrics.evaluate(outputs, ground_truth, snapshot=snapshot, proximity=proximity)
+    summaries = {"overall": TrajectoryMetrics.summarize(columns)}
+    for by in breakdowns:
+        summaries[by] = TrajectoryMetrics.summarize(columns, by=by)
+
+    for section, summary in summaries.items():
+        click.echo(f"\n{section}")
+        click.echo(f"{'':<32}{'n':>8}" + "".join(f"{metric:>10}" for metric in METRICS))
+        for name, values in summary.items():
+            click.echo(f"{name[:31]:<32}{values['trajectories']:>8}" + "".join(
+                f"{values[metric]:>9.1%} " if metric in ("TCE", "TCP", "TCC") else f"{values[metric]:>10.1f}"
+                for metric in METRICS
+            ))
+
+    if out is not None:
+        with open(out, mode="w", encoding="utf-8") as f:
+            json.dump(summaries, f, indent=4, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import os
+import json
+import multiprocessing
+import rich_click as click
+
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dotenv import load_dotenv, find_dotenv
+from typing import List, Dict, Tuple, Optional
+
+from utils.items import MultiModels
+
+
+def split_questions(pairs: Tuple[str, ...], combined: Optional[str]) -> Dict[str, Tuple[str, List[dict]]]:
+    """
+    group the questions by database, `db:gt.json` pairs are taken as is, a combined file is split on its `city` field.
+    :return: {db: (gt stem, questions)}
+    """
+    groups = {}
+    for pair in pairs:
+        db, gt = pair.split(":", 1)
+        with open(gt, mode="r", encoding="utf-8") as f:
+            groups[db] = (Path(gt).stem, json.load(f))
+
+    if combined is not None:
+        with open(combined, mode="r", encoding="utf-8") as f:
+            by_city = defaultdict(list)
+            for question in json.load(f):
+                by_city[question["city"]].append(question)
+        for db, questions in by_city.items():
+            groups[db] = (f"{Path(combined).stem}_{db}", questions)
+
+    return groups
+
+
+def run_shard(env: str,
+              db: str,
+              shard_json: str,
+              output: str,
+              agent: str,
+              api_base: Optional[str],
+              step: int,
+              repeat: int,
+              snapshot: bool,
+              write_policy: str,
+              memory: str,
+              persist_memory: bool,
+              concurrency: int) -> str:
+    """
+    simulate one shard in a fresh process, with its own neo4j client, logger and agent.
+    """
+    from utils.operation import get_store_json_path
+
+    load_dotenv(find_dotenv(env, raise_error_if_not_found=True), override=True)
+    if api_base:
+        os.environ["OPENAI_API_BASE"] = api_base
+    # an existing output is resumed from its manifest.
+    get_store_json_path(shard_json, db, MultiModels[agent], "INFO", resume=output)
+
+    from utils.map_logger import logger
+    from src.map import build_map
+
+    logger.info(f"Shard {Path(shard_json).stem} of {db} is served by {os.getenv('OPENAI_API_BASE')}")
+    street_map = build_map(
+        db_name=db,
+        gt_json=shard_json,
+        agent=MultiModels[agent],
+        use_snapshot=snapshot,
+        write_policy=write_policy,
+        memory=memory,
+        persist_memory=persist_memory
+    )
+    street_map.run(max_steps=step, repeat_num_for_single_question=repeat, concurrency=concurrency)
+
+    return output
+
+
+def merge_shards(outputs: List[str], merged: str) -> int:
+    """
+    concatenate the shard outputs in shard order and export them as a json array next to `merged`.
+    """
+    from utils.operation import convert_trajectories
+
+    with open(merged, mode="wb") as f:
+        for output in outputs:
+            if Path(output).exists():
+                with open(output, mode="rb") as shard:
+                    for line in shard:
+                        if line.endswith(b"\n"):
+                            f.write(line)
+
+    return convert_trajectories(merged, Path(merged).with_suffix(".json").as_posix())
+
+
+@click.command()
+@click.option("-e", "--env", default=".env", type=click.Path(exists=True), help="Path to the .env file.")
+@click.option("-p", "--pair", "pairs", multiple=True, type=click.STRING,
+              help="`db:gt.json` pair, can be given several times.")
+@click.option("-g", "--gt", default=None, type=click.Path(exists=True),
+              help="combined .json file, questions are routed to the database named by their `city` field.")
+@click.option("-a", "--agent", required=True, type=click.Choice([option.name for option in MultiModels]),
+              help="space agent to run.")
+@click.option("-o", "--out", default="output_dir/launch", type=click.Path(file_okay=False),
+              help="output directory, rerunning with the same directory and shard size resumes unfinished shards.")
+@click.option("-n", "--workers", default=os.cpu_count(), type=click.INT, help="number of worker processes.")
+@click.option("--shard-size", default=50, type=click.INT, help="number of questions per shard.")
+@click.option("--replicas", default=None, type=click.STRING,
+              help="comma separated OPENAI_API_BASE urls, shards are assigned to them round-robin.")
+@click.option("-s", "--step", default=35, type=click.INT, help="max steps for simulation in single epoch")
+@click.option("-r", "--repeat", default=1, type=click.INT, help="repeat nums for one question.")
+@click.option("--snapshot/--no-snapshot", default=False,
+              help="serve navigation reads from an in-memory snapshot of the graph.")
+@click.option("-w", "--write-policy", default="sync", type=click.Choice(["sync", "step", "round", "timer"]),
+              help="when buffered per-step graph writes are flushed to neo4j.")
+@click.option("-m", "--memory", default="graph", type=click.Choice(["episode", "graph"]),
+              help="keep the round state of each question in memory, or on the shared neo4j graph.")
+@click.option("--persist-memory", is_flag=True, default=False,
+              help="write the in-memory round state of each question to neo4j once it is finished.")
+@click.option("-c", "--concurrency", default=1, type=click.INT, help="number of questions simulated at the same time, needs --memory episode above 1.")
+@click.option("--merge-only", is_flag=True, default=False, help="only merge the existing shard outputs.")
+def main(env: str, pairs: Tuple[str, ...], gt: str, agent: str, out: str, workers: int, shard_size: int,
+         replicas: str, step: int, repeat: int, snapshot: bool, write_policy: str, memory: str,
+         persist_memory: bool, concurrency: int, merge_only: bool):
+    """
+    Shard the questions of several cities across worker processes, then merge the per-shard trajectories
+    into one output per city.
+    """
+    if not pairs and gt is None:
+        raise click.UsageError("give at least one --pair or a combined --gt file.")
+    api_bases = [url.strip() for url in replicas.split(",")] if replicas else [None]
+
+    tasks, outputs = [], {}
+    for db, (stem, questions) in split_questions(pairs, gt).items():
+        shard_dir = Path(out) / db / "shards"
+        shard_dir.mkdir(exist_ok=True, parents=True)
+        outputs[db] = ((Path(out) / db / f"{agent}_{stem}.jsonl").as_posix(), [])
+        for k, start in enumerate(range(0, len(questions), shard_size)):
+            shard_json = shard_dir / f"{stem}_shard{k:03d}.json"
+            with open(shard_json, mode="w", encoding="utf-8") as f:
+                json.dump(questions[start: start + shard_size], f, ensure_ascii=False)
+            output = (Path(out) / db / f"{agent}_{stem}_shard{k:03d}.jsonl").absolute().as_posix()
+            outputs[db][1].append(output)
+            tasks.append((env, db, shard_json.as_posix(), output, agent, api_bases[len(tasks) % len(api_bases)],
+                          step, repeat, snapshot, write_policy, memory, persist_memory, concurrency))
+
+    if not merge_only:
+        click.echo(f"Running {len(tasks)} shards of {len(outputs)} databases on {workers} workers.")
+        # every shard gets a fresh process, the logger and the model settings are read once per process.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 max_tasks_per_child=1) as pool:
+            futures = {pool.submit(run_shard, *task): task for task in tasks}
+            for future in as_completed(futures):
+                try:
+                    click.echo(f"Finished shard {future.result()}")
+                except Exception as e:  # noqa
+                    click.echo(f"Shard {futures[future][3]} failed, rerun to resume it: {e}", err=True)
+
+    for db, (merged, shard_outputs) in outputs.items():
+        num = merge_shards(shard_outputs, merged)
+        click.echo(f"Merged {num} trajectories of {db} into {Path(merged).with_suffix('.json')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
-import inquirer
+import numpy as np
 import rich_click as click
 
+from typing import Optional
 from dotenv import load_dotenv, find_dotenv
 
 from utils.items import MultiModels
@@ -8,6 +9,8 @@ from utils.operation import get_store_json_path
 
 
 def ask_user_choice():
+    import inquirer
+
     choices = [option.value for option in MultiModels]
 
     question = [
@@ -23,16 +26,49 @@ def ask_user_choice():
     return selected_option
 
 
+def parse_question_range(ctx, param, value: Optional[str]) -> Optional[range]:
+    if value is None:
+        return None
+    try:
+        start, end = value.split(":")
+        return range(int(start or 0), int(end) if end else np.iinfo(np.int64).max)
+    except ValueError:
+        raise click.BadParameter("expected START:END, e.g. 0:100, 50: or :20.")
+
+
 @click.command()
 @click.option("-e", "--env", default=".env", type=click.Path(exists=True), help="Path to the .env file.")
+@click.option("-a", "--agent", "agent_name", default=None, type=click.Choice([option.name for option in MultiModels]),
+              help="space agent to run, asked interactively when not given.")
 @click.option("-d", "--db", default="beijing1", type=click.STRING, help="database name in neo4j")
 @click.option("-s", "--step", default=35, type=click.INT, help="max steps for simulation in single epoch")
 @click.option("-g", "--gt", default="example/ny-hk1-sh/final_ny_QA.json",
               type=click.Path(exists=True), help="Path to the .json file.")
 @click.option("-r", "--repeat", default=1, type=click.INT, help="repeat nums for one question.")
-def main(env: str, db: str, step: int, gt: str, repeat: int):
-    agent = ask_user_choice()
-    store_json = get_store_json_path(gt, db, agent, "INFO")
+@click.option("--snapshot/--no-snapshot", default=False,
+              help="serve navigation reads from an in-memory snapshot of the graph.")
+@click.option("-w", "--write-policy", default="sync", type=click.Choice(["sync", "step", "round", "timer"]),
+              help="when buffered per-step graph writes are flushed to neo4j.")
+@click.option("-m", "--memory", default="graph", type=click.Choice(["episode", "graph"]),
+              help="keep the round state of each question in memory, or on the shared neo4j graph.")
+@click.option("--persist-memory", is_flag=True, default=False,
+              help="write the in-memory round state of each question to neo4j once it is finished.")
+@click.option("-c", "--concurrency", default=1, type=click.INT, help="number of questions simulated at the same time, needs --memory episode above 1.")
+@click.option("--resume", default=None, type=click.Path(exists=True, dir_okay=False),
+              help="existing .jsonl output of an interrupted run, finished rounds are skipped and results appended.")
+@click.option("--service", "services", multiple=True, type=click.STRING,
+              help="only run questions of this service (or folder), can be given several times.")
+@click.option("--category", "categories", multiple=True, type=click.STRING,
+              help="only run questions of this category, e.g. question1, can be given several times.")
+@click.option("--questions", "question_range", default=None, type=click.STRING, callback=parse_question_range,
+              help="only run the question_idx in START:END, END excluded.")
+@click.option("--sample", default=None, type=click.INT, help="run a random sample of this many questions.")
+@click.option("--seed", default=0, type=click.INT, help="seed of --sample.")
+def main(env: str, agent_name: str, db: str, step: int, gt: str, repeat: int, snapshot: bool, write_policy: str,
+         memory: str, persist_memory: bool, concurrency: int, resume: str, services: tuple, categories: tuple,
+         question_range: Optional[range], sample: int, seed: int):
+    agent = MultiModels[agent_name] if agent_name else ask_user_choice()
+    store_json = get_store_json_path(gt, db, agent, "INFO", resume=resume)
     from utils.map_logger import logger
 
     logger.info(f"Simulation trajectories will be saved into file {store_json}")
@@ -41,25 +77,31 @@ def main(env: str, db: str, step: int, gt: str, repeat: int):
         logger.success(f"Loaded environment variables from {env}.")
     else:
         logger.error(f"Failed to load environment variables from {env}.")
-    from src.map import Map
+    from src.map import build_map
+    from utils.ground_truth import QuestionSource
 
-    street_map = Map.from_json(
+    street_map = build_map(
         db_name=db,
         gt_json=gt,
         agent=agent,
-        backtrack=True,
-        backtrack_steps=3,
-        backtrack_mechanism="confidence",
-        use_backtrack_prompt=False,
-        retrieve=False,
-        retrieve_epoch=3,
-        retrieve_method="topology",
-        retrieve_distance=1,
-        use_history_trajectory=False,
-        history_steps=3
+        use_snapshot=snapshot,
+        write_policy=write_policy,
+        memory=memory,
+        persist_memory=persist_memory
     )
+    questions = QuestionSource(street_map.ground_truth_trajectories)
+    if services:
+        questions = questions.where(service=services)
+    if categories:
+        questions = questions.where(category=categories)
+    if question_range is not None:
+        questions = questions.where(question_idx=question_range)
+    if sample:
+        questions = questions.sample(sample, seed=seed)
+    logger.info(f"{len(questions)} of {len(street_map.ground_truth_trajectories)} questions selected.")
+
     street_map.run(
-        max_steps=step, repeat_num_for_single_question=repeat,
+        max_steps=step, repeat_num_for_single_question=repeat, concurrency=concurrency, questions=questions
     )
 
 
@@ -0,0 +1,86 @@
+import os
+import rich_click as click
+
+from pathlib import Path
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv, find_dotenv
+
+
+@click.command()
+@click.option("-e", "--env", default=".env", type=click.Path(exists=True), help="Path to the .env file.")
+@click.option("-d", "--db", default="beijing1", type=click.STRING, help="database name in neo4j")
+@click.option("-o", "--out", default=None, type=click.Path(),
+              help="store directory, defaults to $PERSPECTIVE_STORE, one sub-directory is created per city.")
+@click.option("-w", "--workers", default=os.cpu_count(), type=click.INT, help="number of rendering processes.")
+@click.option("-q", "--quality", default=95, type=click.INT, help="JPEG quality of the stored images.")
+@click.option("--pano/--no-pano", default=True, help="store the full pano of every viewpoint as well.")
+@click.option("-a", "--agent", default=None, type=click.STRING,
+              help="render with the payload policy (resolution, quality) of this agent, overrides --quality.")
+def main(env: str, db: str, out: str, workers: int, quality: int, pano: bool, agent: str):
+    """
+    Render every walkable perspective of every `Point` of a city into a packed file read by the agents.
+    Interrupted runs are resumed from the existing store.
+    """
+    # environment must be loaded before PanoVisualizer reads IMAGE_STORE and PANO_MODE.
+    load_dotenv(find_dotenv(env, raise_error_if_not_found=True), verbose=True, override=True)
+    out = Path(out or os.environ["PERSPECTIVE_STORE"])
+
+    os.environ["STORE_JSON"] = (out / db / "precompute.jsonl").as_posix()
+    os.environ["CITY_NAME"] = db
+    os.environ["SECTION"] = "precompute"
+    os.environ["AGENT"] = "precompute"
+    os.environ["LOG_LEVEL"] = "INFO"
+    (out / db).mkdir(exist_ok=True, parents=True)
+
+    from utils.map_logger import logger
+    from utils.client import Neo4jClient
+    from utils.items import PanoParams
+    from utils.cache import EncodedImageCache
+    from utils.store import PerspectiveStoreWriter, render_viewpoint
+    from utils.payload import PayloadPolicy
+
+    params = PanoParams().to_dict(encode_json=True)  # noqa
+    pano_params = {}
+    if agent is not None:
+        policy = PayloadPolicy.for_agent(agent)
+        params, pano_params, quality = policy.perspective_params(params), policy.pano_params, policy.quality
+    writer = PerspectiveStoreWriter(out / db, params=params, quality=quality)
+    snapshot = Neo4jClient(db, snapshot=True).snapshot
+
+    tasks = []
+    for i, filename in enumerate(snapshot.filenames):
+        viewpoint = snapshot.retrieve_viewpoint_from_filename(filename)
+        keys = [EncodedImageCache.make_key(filename, h, params, quality) for h in viewpoint.walkable_headings]
+        if pano:
+            keys.append(EncodedImageCache.make_key(filename, None, pano_params, quality))
+        done = tuple(key for key in keys if key in writer)
+        if len(done) < len(keys):
+            tasks.append((filename, viewpoint.heading, viewpoint.walkable_headings, params, quality, pano, done,
+                          pano_params))
+
+    logger.info(f"{len(snapshot) - len(tasks)} / {len(snapshot)} viewpoints already stored in {out / db}.")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+            tqdm(total=len(tasks), desc="Rendering", unit="viewpoint", colour="#a5d8ff") as pbar:
+        pending = set()
+        tasks = iter(tasks)
+        while True:
+            # keep a bounded number of viewpoints in flight so results are written as they arrive.
+            for task in tasks:
+                pending.add(pool.submit(render_viewpoint, *task))
+                if len(pending) >= workers * 4:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                writer.write(future.result())
+                pbar.update(1)
+
+    writer.close()
+    logger.success(f"Stored {len(writer.index)} images into {out / db}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,51 @@
 from __future__ import annotations
 
-import importlib
 import numpy as np
 from tqdm import tqdm
 from datetime import datetime
 from collections import deque
-from typing import List, Optional, Literal, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Literal, Union, Iterator
 
+from src.mllm.registry import create_agent
 from utils.client import Neo4jClient
-from utils.map_logger import logger
-from utils.operation import read_json, check_env_variables, is_increasing, Compass
+from utils.memory import EpisodeMemory
+from utils.map_logger import logger, TrajectoryBuffer
+from utils.ground_truth import GroundTruthColumns, QuestionSource
+from utils.operation import check_env_variables, is_increasing, Compass
 from utils.items import GroundTruthTrajectories, ViewPointPosition, MultiModels, StopStatus, \
-    ViewPointPositionWithObservation, LastStepMemory, ViewPointAttrToUpdate, Direction
+    ViewPointPositionWithObservation, LastStepMemory, ViewPointAttrToUpdate, Direction, ViewPoint, \
+    SimulationTrajectories
+
+
+class Episode:
+    """
+    navigation state of one round of one question, kept apart from `Map` so that several
+    questions can be simulated at the same time.
+    """
+
+    def __init__(self,
+                 single_traj_gt: GroundTruthTrajectories.SingleTrajectory,
+                 memory: Union[EpisodeMemory, Neo4jClient],
+                 backtrack_steps: int = 0):
+        self.single_traj_gt = single_traj_gt
+        # round state of the question, shared by its rounds.
+        self.memory = memory
+
+        self.start_position: ViewPointPosition = single_traj_gt.complete_route[0]
+        self.last_position: Optional[ViewPointPosition] = None
+        self.viewpoint: Optional[ViewPoint] = None
+        self.update_viewpoint: Optional[ViewPointAttrToUpdate] = None
+        self._distance = 0
+
+        self.already_backtracked = False
+        self.score_container = deque(maxlen=backtrack_steps)
+        self.action_container = deque(maxlen=backtrack_steps)
+
+        self.last_step_memory: LastStepMemory = LastStepMemory()
+        self.next_action_direction: str = Direction.FRONT.value
+
+        self.buffer = TrajectoryBuffer()
 
 
 class Map:
@@ -31,24 +65,17 @@ class Map:
                  retrieve_method: Literal["topology", "spatial"] = "topology",
                  retrieve_distance: Union[int, float] = 1,
                  use_history_trajectory: bool = False,
-                 history_steps: int = 3
+                 history_steps: int = 3,
+                 use_snapshot: bool = False,
+                 write_policy: Literal["sync", "step", "round", "timer"] = "sync",
+                 memory: Literal["episode", "graph"] = "graph",
+                 persist_memory: bool = False
                  ):
 
-        module = importlib.import_module("src.mllm")
+        self.agent = create_agent(agent)
+        self.graph_client = Neo4jClient(db_name, snapshot=use_snapshot, write_policy=write_policy)
 
-        self.agent = getattr(module, agent.value).__call__()
-        self.graph_client = Neo4jClient(db_name)
-
-        """
-        map status
-        """
-        self.start_position = None
-        self.last_position = None
-        self._distance = 0
-
-        self.ground_truth_trajectories: GroundTruthTrajectories = GroundTruthTrajectories.from_dict(
-            read_json(gt_json)
-        )
+        self.ground_truth_trajectories: GroundTruthColumns = GroundTruthColumns.from_json(gt_json)
 
         """
         backtrack
@@ -59,7 +86,6 @@ class Map:
         self.backtrack_threshold = backtrack_threshold
         self.backtrack_mechanism = backtrack_mechanism
 
-        self.already_backtracked = False
         self.use_backtrack_prompt = use_backtrack_prompt
 
         if self.backtrack:
@@ -75,9 +101,6 @@ class Map:
             else:
                 raise ValueError("backtrack_mechanism should be either 'confidence' or 'topo_distance'.")
 
-            self.score_container = deque(maxlen=backtrack_steps)
-            self.action_container = deque(maxlen=backtrack_steps)
-
         """
         retrieve
         """
@@ -86,18 +109,23 @@ class Map:
         self.retrieve_method = retrieve_method
         self.retrieve_distance = retrieve_distance
 
-        """
-        last step memory
-        """
-        self.last_step_memory: LastStepMemory = LastStepMemory()
-        self.next_action_direction: str = Direction.FRONT.value
-
         """
         use history trajectory
         """
         self.use_history_trajectory = use_history_trajectory
         self.history_steps = history_steps
 
+        """
+        round state, kept per question in memory or on the shared graph
+        """
+        if memory not in ("episode", "graph"):
+            raise ValueError("memory should be either 'episode' or 'graph'.")
+        self.memory = memory
+        self.persist_memory = persist_memory
+        if memory == "episode" and not persist_memory and write_policy != "sync":
+            logger.warning(f"write_policy={write_policy} has no effect: episode memory only writes round state "
+                           f"to neo4j with persist_memory.")
+
     @classmethod
     def from_json(cls,
                   db_name: str,
@@ -113,7 +141,11 @@ class Map:
                   retrieve_method: Literal["topology", "spatial"] = "topology",
                   retrieve_distance: Union[int, float] = 1,
                   use_history_trajectory: bool = False,
-                  history_steps: int = 3
+                  history_steps: int = 3,
+                  use_snapshot: bool = False,
+                  write_policy: Literal["sync", "step", "round", "timer"] = "sync",
+                  memory: Literal["episode", "graph"] = "graph",
+                  persist_memory: bool = False
                   ) -> Map:
         return cls(
             db_name=db_name,
@@ -129,94 +161,120 @@ class Map:
             retrieve_method=retrieve_method,
             retrieve_distance=retrieve_distance,
             use_history_trajectory=use_history_trajectory,
-            history_steps=history_steps
+            history_steps=history_steps,
+            use_snapshot=use_snapshot,
+            write_policy=write_policy,
+            memory=memory,
+            persist_memory=persist_memory
         )
 
-    def _step(self) -> bool:
+    def _step(self, episode: Episode) -> bool:
         flag = False
         # set visit count in one node.
-        self.graph_client.set_node_visited_once(self.start_position.filename)
-        self.last_position = ViewPointPosition.from_dict(self.start_position.to_dict())
-        self.start_position, self._distance = self.graph_client.get_closest_viewpoint(
-            current_viewpoint=self.viewpoint,
-            azimuth=self.viewpoint.walkable_headings[self.update_viewpoint.pred_action]
+        episode.memory.set_node_visited_once(episode.start_position.filename)
+        episode.last_position = ViewPointPosition.from_dict(episode.start_position.to_dict())
+        episode.start_position, episode._distance = self.graph_client.get_closest_viewpoint(
+            current_viewpoint=episode.viewpoint,
+            azimuth=episode.viewpoint.walkable_headings[episode.update_viewpoint.pred_action]
         )
         # 先求出上一步的方向方位角，才能求出这一步的行走方向
-        self.last_step_memory.last_forward_azimuth = Compass.get_step_forward_azimuth(self.last_position,
-                                                                                      self.start_position)
-        self.next_action_direction = Compass.get_relative_direction(
-            self.last_step_memory.last_forward_azimuth,
-            self.viewpoint.walkable_headings[self.update_viewpoint.pred_action]
+        episode.last_step_memory.last_forward_azimuth = self.graph_client.get_step_forward_azimuth(
+            episode.last_position, episode.start_position
+        )
+        episode.next_action_direction = Compass.get_relative_direction(
+            episode.last_step_memory.last_forward_azimuth,
+            episode.viewpoint.walkable_headings[episode.update_viewpoint.pred_action]
         ).value
 
         logger.info("step forward.")
         # store score of each point
         if self.backtrack:
             if self.backtrack_mechanism == "confidence":
-                self.score_container.append(self.update_viewpoint.score)
+                episode.score_container.append(episode.update_viewpoint.score)
             elif self.backtrack_mechanism == "topo_distance":
-                self.score_container.append(self.graph_client.get_steps_between_two_viewpoints(self.start_position,
-                                                                                               self.single_traj_gt.complete_route[
-                                                                                                   -1]))
+                episode.score_container.append(self.graph_client.get_steps_between_two_viewpoints(
+                    episode.start_position,
+                    episode.single_traj_gt.complete_route[-1]
+                ))
             else:
                 raise ValueError("backtrack_mechanism should be either 'confidence' or 'topo_distance'.")
-            self.action_container.append(self.update_viewpoint.pred_action)
-            flag = self._should_backtrack()
+            episode.action_container.append(episode.update_viewpoint.pred_action)
+            flag = self._should_backtrack(episode)
 
         return flag
 
     def _run_for_single_epoch(self,
                               single_traj_gt: GroundTruthTrajectories.SingleTrajectory,
                               **kwargs
-                              ) -> None:
-        self.single_traj_gt = single_traj_gt
+                              ) -> Iterator[SimulationTrajectories.Trajectory]:
+        memory = EpisodeMemory(self.graph_client.topology) if self.memory == "episode" else self.graph_client
+        finished = {
+            round_num for round_num in range(1, kwargs["repeat_num_for_single_question"] + 1)
+            if logger.is_completed(single_traj_gt.question_idx, single_traj_gt.idx, round_num)
+        }
+        # the round state of finished rounds is on the graph, an episode memory is restored from the one saved
+        # with its last finished round. Without it, the rounds are simulated again only if the state is read.
+        replay = False
+        if finished and self.memory == "episode":
+            state = logger.load_memory(single_traj_gt.question_idx, single_traj_gt.idx, max(finished))
+            if state is not None:
+                memory.restore(state)
+                logger.info(f"Question {single_traj_gt.question_idx} resumed after round {max(finished)}, "
+                            f"round state restored.")
+            elif self.retrieve or self.use_history_trajectory or self.persist_memory:
+                replay = True
+                logger.info(f"Question {single_traj_gt.question_idx} resumed part-way without saved round state, "
+                            f"replaying finished rounds {sorted(finished)} to rebuild it.")
         for round_num in range(1, kwargs["repeat_num_for_single_question"] + 1):
+            if round_num in finished and not replay:
+                logger.info(f"Round {round_num} of question {single_traj_gt.question_idx} already finished, skip.")
+                continue
             start_time = datetime.now()
             flag = False  # stand for achieve the goal.
-            self.last_position: ViewPointPosition
-            self.start_position: ViewPointPosition = single_traj_gt.complete_route[0]
+            episode = Episode(single_traj_gt, memory, backtrack_steps=self.backtrack_steps)
 
             logger.opt(colors=True).info(
                 f"The question {single_traj_gt.question_idx} is <red>**{single_traj_gt.question}**</red>")
             logger.opt(colors=True).info(
                 f"The type of this question belongs to <red>**{single_traj_gt.service}**</red>")
 
-            logger.info(f"Starting from {self.start_position} | Repeat num: {round_num}")
+            logger.info(f"Starting from {episode.start_position} | Repeat num: {round_num}")
 
-            with tqdm(total=kwargs["max_steps"], desc='Searching...', unit='step', colour="#a5d8ff") as pbar:
+            with tqdm(total=kwargs["max_steps"], desc='Searching...', unit='step', colour="#a5d8ff",
+                      disable=kwargs.get("concurrency", 1) > 1) as pbar:
 
                 current_step = 1
                 while current_step <= kwargs["max_steps"]:
                     logger.opt(colors=True).info(f"<blue>{'-' * 100}</blue>")
-                    self.viewpoint = self.graph_client.retrieve_viewpoint_from_filename(
-                        self.start_position.filename
+                    episode.viewpoint = self.graph_client.retrieve_viewpoint_from_filename(
+                        episode.start_position.filename
                     )
-                    if self.already_backtracked and self.use_backtrack_prompt:
+                    if episode.already_backtracked and self.use_backtrack_prompt:
                         prompt_perspective_idx = self.graph_client.get_proper_perspective_after_backtrack(
-                            self.start_position,
-                            self.ground_truth_trajectories.data[-1].complete_route[-1],
-                            current_walkable_headings=self.viewpoint.walkable_headings
+                            episode.start_position,
+                            single_traj_gt.complete_route[-1],
+                            current_walkable_headings=episode.viewpoint.walkable_headings
                         )
                     else:
                         prompt_perspective_idx = None
 
                     params = {
                         "question": single_traj_gt.question,
-                        "viewpoint": self.viewpoint,
-                        "last_position": self.last_position,
-                        "curr_position": self.start_position,
-                        "last_forward_azimuth": self.last_step_memory.last_forward_azimuth,
+                        "viewpoint": episode.viewpoint,
+                        "last_position": episode.last_position,
+                        "curr_position": episode.start_position,
+                        "last_forward_azimuth": episode.last_step_memory.last_forward_azimuth,
                         "prompt_perspective_idx": prompt_perspective_idx,
-                        "backtracked": self.already_backtracked
+                        "backtracked": episode.already_backtracked
                     }
 
                     if self.retrieve and round_num % self.retrieve_epoch == 0:
                         logger.info("retrieving...")
                         if self.retrieve_method == "topology":
-                            retrieved_info = self.graph_client.query_topology_distance(self.start_position.filename,
+                            retrieved_info = memory.query_topology_distance(episode.start_position.filename,
                                                                                        topology_distance=self.retrieve_distance)
                         elif self.retrieve_method == "spatial":
-                            retrieved_info = self.graph_client.query_spatial_distance(self.start_position.filename,
+                            retrieved_info = memory.query_spatial_distance(episode.start_position.filename,
                                                                                       spatial_distance=self.retrieve_distance)
                         else:
                             raise NotImplementedError(
@@ -228,90 +286,92 @@ class Map:
 
                     if self.use_history_trajectory and current_step > self.history_steps:
                         logger.info("using history trajectories...")
-                        history_nodes = self.graph_client.get_serval_nodes(
-                            list(logger.trajectory.queue)[-self.history_steps:])  # 顺序
+                        history_nodes = memory.get_serval_nodes(
+                            list(episode.buffer.trajectory.queue)[-self.history_steps:])  # 顺序
 
                         params.update({
                             "history_nodes_prompt": history_nodes
                         })
 
-                    self.update_viewpoint: ViewPointAttrToUpdate = self.agent.observe_and_think(
+                    episode.update_viewpoint = self.agent.observe_and_think(
                         **params
                     )
-                    self.already_backtracked = False
+                    episode.already_backtracked = False
                     logger.info(f"""
                     
-                    Overall Observation: {self.update_viewpoint.observations}
-                    Perspective Observation: {self.update_viewpoint.perspective_observation}
-                    Thoughts: {self.update_viewpoint.thought}
-                    Action: {self.update_viewpoint.pred_action}
-                    Score: {self.update_viewpoint.score}
+                    Overall Observation: {episode.update_viewpoint.observations}
+                    Perspective Observation: {episode.update_viewpoint.perspective_observation}
+                    Thoughts: {episode.update_viewpoint.thought}
+                    Action: {episode.update_viewpoint.pred_action}
+                    Score: {episode.update_viewpoint.score}
                     """)
 
-                    # update the node attribution to neo4j
-                    self.graph_client.update_node_attribution(self.update_viewpoint)
-
+                    # update the node attribution in the round state
+                    memory.update_node_attribution(episode.update_viewpoint)
 
-                        # step to next position
+                    # step to next position
                     logger.insert_step(
                         ViewPointPositionWithObservation.from_viewpoint_position(
-                            self.start_position,
-                            self.update_viewpoint
+                            episode.start_position,
+                            episode.update_viewpoint
                         ),
-                        self._distance
+                        episode._distance,
+                        buffer=episode.buffer
                     )
-                    
-                    if self.update_viewpoint.pred_action == StopStatus.REACHED.value:
-                        flag = True                    
+
+                    if episode.update_viewpoint.pred_action == StopStatus.REACHED.value:
+                        flag = True
                         break
 
-                    should_backtrack = self._step()
+                    should_backtrack = self._step(episode)
 
-                    # update the extra node attribution in neo4j
-                    self.graph_client.set_node_in_current_round(
-                        filename=self.update_viewpoint.filename,
+                    # update the extra node attribution in the round state
+                    memory.set_node_in_current_round(
+                        filename=episode.update_viewpoint.filename,
                         current_round=round_num,
-                        thought=self.update_viewpoint.thought,
-                        last_step_filename=self.last_step_memory.last_step_filename,
-                        last_action=self.last_step_memory.last_action,
-                        last_action_direction=self.last_step_memory.last_action_direction,
-                        last_score=self.last_step_memory.last_score,
-                        next_step_filename=self.start_position.filename,
-                        next_action=self.update_viewpoint.pred_action,
-                        next_action_direction=self.next_action_direction,
-                        next_score=self.update_viewpoint.score
+                        thought=episode.update_viewpoint.thought,
+                        last_step_filename=episode.last_step_memory.last_step_filename,
+                        last_action=episode.last_step_memory.last_action,
+                        last_action_direction=episode.last_step_memory.last_action_direction,
+                        last_score=episode.last_step_memory.last_score,
+                        next_step_filename=episode.start_position.filename,
+                        next_action=episode.update_viewpoint.pred_action,
+                        next_action_direction=episode.next_action_direction,
+                        next_score=episode.update_viewpoint.score
                     )
 
-                    # update the edge attribution in neo4j
-                    self.graph_client.set_edge_in_current_round(
+                    # update the edge attribution in the round state
+                    memory.set_edge_in_current_round(
                         round=round_num,
                         step=current_step,
-                        action=self.update_viewpoint.pred_action,
-                        action_direction=self.next_action_direction,
-                        source_filename=self.last_position.filename,
-                        target_filename=self.start_position.filename
+                        action=episode.update_viewpoint.pred_action,
+                        action_direction=episode.next_action_direction,
+                        source_filename=episode.last_position.filename,
+                        target_filename=episode.start_position.filename
                     )
 
-                    self._update_last_step_memory()
+                    self._update_last_step_memory(episode)
+                    self.graph_client.end_step()
 
                     current_step += 1
                     pbar.update(1)
 
                     # check if backtrack
                     if should_backtrack:
-                        self._backtrack()
-                        self.backtrack_steps = True
+                        self._backtrack(episode)
+                        episode.already_backtracked = True
                         pbar.update(self.backtrack_steps)
                         current_step += self.backtrack_steps
 
                 logger.opt(colors=True).info(f"<blue>{'-' * 100}</blue>")
 
             cost = (datetime.now() - start_time).total_seconds()
-            total_weight = sum(logger.distance_container)
-            total_steps = len(logger.trajectory.queue)
+            total_weight = sum(episode.buffer.distance_container)
+            total_steps = len(episode.buffer.trajectory.queue)
 
             # set flag in this round
-            self.graph_client.set_node_round_success(round_num, flag)
+            self.graph_client.end_round()
+            memory.set_node_round_success(round_num, flag)
 
             if flag:
                 logger.success(
@@ -321,87 +381,184 @@ class Map:
                     f"The agent DOES NOT reach the target with total_steps {total_steps} total_weight {total_weight}")
 
             # set all visited viewpoint in this epoch to history visited
-            self.graph_client.set_history_visited()
+            memory.set_history_visited()
 
             # clean if reached retrieve_epoch
             if round_num % self.retrieve_epoch == 0:
-                self.graph_client.reset_node_attribution(self.retrieve_epoch)
-                self.graph_client.reset_edge_attribution(self.retrieve_epoch)
+                memory.reset_node_attribution(self.retrieve_epoch)
+                memory.reset_edge_attribution(self.retrieve_epoch)
 
-            if self.start_position.filename == single_traj_gt.complete_route[-1].filename:
+            if episode.start_position.filename == single_traj_gt.complete_route[-1].filename:
                 round_success = True
             else:
                 round_success = False
 
-            logger.make_single_trajectory(
+            trajectory = logger.build_single_trajectory(
                 question=single_traj_gt.question,
                 question_idx=single_traj_gt.question_idx,
                 idx=single_traj_gt.idx,
                 _from=single_traj_gt._from,  # noqa
-                to=logger.trajectory.queue[-1].filename,
+                to=episode.buffer.trajectory.queue[-1].filename,
                 service=single_traj_gt.service,
                 total_weight=total_weight,
                 total_steps=total_steps,
                 flag=flag,
                 cost=cost,
                 round_num=round_num,
-                round_success=round_success
+                round_success=round_success,
+                buffer=episode.buffer
             )
+            if round_num not in finished:
+                if self.memory == "episode":
+                    logger.save_memory(single_traj_gt.question_idx, single_traj_gt.idx, round_num, memory.state())
+                yield trajectory
+
+        if self.memory == "episode" and self.persist_memory:
+            memory.persist(self.graph_client)
+
+    def _update_last_step_memory(self, episode: Episode):
+        episode.last_step_memory.last_step_filename = episode.update_viewpoint.filename
+        episode.last_step_memory.last_action = episode.update_viewpoint.pred_action
+        episode.last_step_memory.last_action_direction = episode.next_action_direction,
+        episode.last_step_memory.last_score = episode.update_viewpoint.score
+
+    def _is_finished(self, question_idx: int, idx: int, repeat_num: int) -> bool:
+        return all(
+            logger.is_completed(question_idx, idx, round_num)
+            for round_num in range(1, repeat_num + 1)
+        )
+
+    def _run_loop(self, questions: QuestionSource, **kwargs):
+        # finished questions of a resumed run are dropped before any episode view is built.
+        pending = questions.filter_keys(
+            lambda question_idx, idx: not self._is_finished(question_idx, idx, kwargs["repeat_num_for_single_question"])
+        )
+        total = len(pending)
+        if total < len(questions):
+            logger.info(f"{len(questions) - total} trajectories already finished, skip.")
+        concurrency = kwargs.get("concurrency", 1)
+
+        if concurrency <= 1:
+            for idx, gt in enumerate(pending):
+                logger.info(f"Start running trajectory {idx + 1} / {total}")
+                logger.opt(colors=True).info(f"<blue>{'=' * 112}</blue>")
+                for trajectory in self._run_for_single_epoch(gt, **kwargs):
+                    logger.save_trajectory(trajectory)
+                logger.success(f"Finished running trajectory {idx + 1} / {total}")
+                logger.opt(colors=True).info(f"<blue>{'=' * 112}</blue>")
+            return
+
+        logger.info(f"Running {total} trajectories with {concurrency} concurrent episodes.")
+        pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="episode")
+        try:
+            # at most 2 * concurrency episodes are submitted ahead, results are written in question order,
+            # whatever order the episodes finish in.
+            futures = deque()
+            source = iter(pending)
+            with tqdm(total=total, desc='Questions', unit='question', colour="#a5d8ff") as pbar:
+                for idx in range(total):
+                    while len(futures) < 2 * concurrency:
+                        gt = next(source, None)
+                        if gt is None:
+                            break
+                        futures.append(pool.submit(lambda single_traj_gt: list(
+                            self._run_for_single_epoch(single_traj_gt, **kwargs)), gt))
+                    for trajectory in futures.popleft().result():
+                        logger.save_trajectory(trajectory)
+                    logger.success(f"Finished running trajectory {idx + 1} / {total}")
+                    pbar.update(1)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
 
-    def _update_last_step_memory(self):
-        self.last_step_memory.last_step_filename = self.update_viewpoint.filename
-        self.last_step_memory.last_action = self.update_viewpoint.pred_action
-        self.last_step_memory.last_action_direction = self.next_action_direction,
-        self.last_step_memory.last_score = self.update_viewpoint.score
-
-    def _run_loop(self, **kwargs):
-        for idx, gt in enumerate(self.ground_truth_trajectories.data):
-            logger.info(f"Start running trajectory {idx + 1} / {len(self.ground_truth_trajectories.data)}")
-            logger.opt(colors=True).info(f"<blue>{'=' * 112}</blue>")
-            self._run_for_single_epoch(gt, **kwargs)
-            logger.success(f"Finished running trajectory {idx + 1} / {len(self.ground_truth_trajectories.data)}")
-            logger.opt(colors=True).info(f"<blue>{'=' * 112}</blue>")
-
-    def _should_backtrack(self) -> bool:
+    def _should_backtrack(self, episode: Episode) -> bool:
         flag = False
-        if len(self.score_container) == self.backtrack_steps:
+        if len(episode.score_container) == self.backtrack_steps:
             if self.backtrack_mechanism == "confidence":
-                avg_score = np.average(self.score_container)
+                avg_score = np.average(episode.score_container)
                 if avg_score < self.backtrack_threshold:
                     flag = True
                     logger.warning(
                         f"Average score {avg_score} with {self.backtrack_steps} is below threshold {self.backtrack_threshold}, backtrack!")
             elif self.backtrack_mechanism == "topo_distance":
-                flag = is_increasing(self.score_container)
+                flag = is_increasing(episode.score_container)
                 if flag:
                     logger.warning(
-                        f"Topology distance {self.score_container} is increasing, backtrack!")
+                        f"Topology distance {episode.score_container} is increasing, backtrack!")
             else:
                 logger.error(f"Unknown backtrack mechanism {self.backtrack_mechanism}")
 
         return flag
 
-    def _backtrack(self):
+    def _backtrack(self, episode: Episode):
         """
         backtrack to a new start position
         """
-        backtrack_nodes: List[ViewPointPosition] = list(logger.trajectory.queue)[-self.backtrack_steps - 1: -1]
-        backtrack_distances: List[float] = logger.distance_container[-self.backtrack_steps - 1: -1]
+        backtrack_nodes: List[ViewPointPosition] = list(episode.buffer.trajectory.queue)[-self.backtrack_steps - 1: -1]
+        backtrack_distances: List[float] = episode.buffer.distance_container[-self.backtrack_steps - 1: -1]
         logger.info(f"Starting backtrack with {self.backtrack_steps}")
 
         # back and reset start position
         for node, distance in zip(reversed(backtrack_nodes), reversed(backtrack_distances)):
             logger.insert_step(
                 node,
-                distance
+                distance,
+                buffer=episode.buffer
             )
-            self.start_position = node
+            episode.start_position = node
 
-        logger.success(f"Backtrack to {self.start_position}")
+        logger.success(f"Backtrack to {episode.start_position}")
+
+    def run(self,
+            max_steps: int,
+            repeat_num_for_single_question: int = 1,
+            concurrency: int = 1,
+            questions: Optional[QuestionSource] = None):
+        """
+        :param max_steps: max steps for simulation in single epoch
+        :param repeat_num_for_single_question: repeat nums for one question
+        :param concurrency: number of questions simulated at the same time
+        :param questions: questions to run, every question of the ground truth file by default
+        """
+        if questions is None:
+            questions = QuestionSource(self.ground_truth_trajectories)
+
+        if concurrency > 1 and self.memory == "graph":
+            # round state and the round sweeps are shared by every question on the graph.
+            raise ValueError("questions would overwrite each other's round state on the graph, "
+                             "use memory='episode' with concurrency > 1.")
+
+        if self.backtrack and (self.backtrack_mechanism == "topo_distance" or self.use_backtrack_prompt):
+            self.graph_client.precompute_distances(questions.targets)
 
-    def run(self, max_steps: int, repeat_num_for_single_question: int = 1):
         logger.info(f"Start running with {max_steps} steps and {repeat_num_for_single_question} repeats.")
         self._run_loop(
-            max_steps=max_steps, repeat_num_for_single_question=repeat_num_for_single_question
+            questions,
+            max_steps=max_steps, repeat_num_for_single_question=repeat_num_for_single_question,
+            concurrency=concurrency
         )
+        self.graph_client.close()
+        logger.export_json()
         logger.success("Finished running.")
+
+
+# simulation settings shared by the command line entry points, main.py and launch.py.
+_RUN_SETTINGS = dict(
+    backtrack=True,
+    backtrack_steps=3,
+    backtrack_mechanism="confidence",
+    use_backtrack_prompt=False,
+    retrieve=False,
+    retrieve_epoch=3,
+    retrieve_method="topology",
+    retrieve_distance=1,
+    use_history_trajectory=False,
+    history_steps=3,
+)
+
+
+def build_map(db_name: str, gt_json: str, agent: MultiModels, **options) -> Map:
+    """
+    `Map` with the settings of the command line entry points, `options` (e.g. use_snapshot, write_policy,
+    memory, persist_memory) override them.
+    """
+    return Map.from_json(db_name=db_name, gt_json=gt_json, agent=agent, **{**_RUN_SETTINGS, **options})
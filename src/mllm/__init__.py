@@ -1,64 +1,30 @@
-from .chatgpt import ChatGPT4o
-from .qwen import Qwen2_VL_7B
-from .nvila import NVILA_Lite_8B
-from .minicpm import MiniCPM_V_2_6
-from .intern import InternVL2_5_8B, InternVL2_5_38B
-from .ovis import Ovis1_6_Gemma2_9B
-from .phi import Phi_3_5_vision_instruct
-from .deepseek import deepseek_vl2_small
-from .llama import Llama_3_2_11B_Vision, Llama_3_2V_11B_cot
-from .llava import llava_v1_6_mistral_7b_hf, llava_onevision_qwen2_7b_si, llama3_llava_next_8b_hf
-from .straight import StraightBaselineModel
-from .random import RandomBaselineModel
-
-# __all__ = [
-#     "ChatGPT4o", "Qwen2_VL_7B",
-#     "InternVL2_5_8B", "InternVL2_5_38B",
-#     "Llama_3_2_11B_Vision", "llama3_llava_next_8b_hf",
-#     "deepseek_vl2_small", "Ovis1_6_Gemma2_9B",
-#     "NVILA_Lite_8B", "Phi_3_5_vision_instruct",
-#     "llava_v1_6_mistral_7b_hf", "MiniCPM_V_2_6",
-#     "Llama_3_2V_11B_cot", "llava_onevision_qwen2_7b_si",
-#     "StraightBaselineModel", "RandomBaselineModel"
-# ]
-from .all_models import (
-    InternVL2_5_8B,
-    llama3_llava_next_8b_hf,
-    llava_onevision_qwen2_7b_si_hf,
-    MiniCPM_V_2_6,
-    Phi_3_5_vision_instruct,
-    gpt_4o_mini,
-    Qwen2_VL_7B_Instruct,
-    Llama_3_2_11B_Vision,
-    InternVL2_5_26B,
-    InternVL2_5_38B,
-    deepseek_vl2,
-    Qwen2_VL_72B_Instruct,
-    InternVL2_5_78B,
-    llama3_2_90b,
-    gemini_1_5_pro,
-    claude_3_5_sonnet,
-    MiniMax_01,
-    gemini_2_0_flash_exp
-)
+# agents are imported on first access, so that importing one agent does not pull in the others.
+from .registry import resolve_agent, create_agent
 
 
 __all__ = [
     # S Models (7-16B)
-    "InternVL2_5_8B", "llama3_llava_next_8b_hf", 
-    "llava_onevision_qwen2_7b_si_hf", "MiniCPM_V_2_6", 
-    "Phi_3_5_vision_instruct", "gpt_4o_mini", 
+    "InternVL2_5_8B", "llama3_llava_next_8b_hf",
+    "llava_onevision_qwen2_7b_si_hf", "MiniCPM_V_2_6",
+    "Phi_3_5_vision_instruct", "gpt_4o_mini",
     "Qwen2_VL_7B_Instruct", "Llama_3_2_11B_Vision",
 
     # M Models (26-38B)
     "InternVL2_5_26B", "InternVL2_5_38B", "deepseek_vl2",
 
     # L Models (70-90B)
-    "ChatGPT4o", "Qwen2_VL_72B_Instruct", 
-    "InternVL2_5_78B", "llama3_2_90b", "gemini_1_5_pro", 
-    "claude_3_5_sonnet", "MiniMax_01"
+    "ChatGPT4o", "Qwen2_VL_72B_Instruct",
+    "InternVL2_5_78B", "llama3_2_90b", "gemini_1_5_pro",
+    "claude_3_5_sonnet", "MiniMax_01",
 
     # Uncertain Models
-    "gemini_2_0_flash_exp","StraightBaselineModel", "RandomBaselineModel"
+    "gemini_2_0_flash_exp", "StraightBaselineModel", "RandomBaselineModel",
 
+    "resolve_agent", "create_agent"
 ]
+
+
+def __getattr__(name: str):
+    if name in __all__:
+        return resolve_agent(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
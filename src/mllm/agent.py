@@ -1,40 +1,119 @@
+from __future__ import annotations
+
+import os
+import threading
+
 from retry import retry
 from numpy import ndarray
-from typing import List, Union, Optional
+from typing import List, Union, Optional, Dict, Literal, Callable, TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
 from string import ascii_uppercase
 from abc import ABC, abstractmethod
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
 
+from src.mllm.dispatcher import RequestDispatcher
+from src.mllm.throttle import Throttle, request_errors
 from utils.map_logger import logger
+from utils.cache import EncodedImageCache, ResponseCache, ResponseCacheMiss
+from utils.store import PerspectiveStore
+from utils.payload import PayloadPolicy
 from utils.panovis import PanoVisualizer
-from utils.parser import CityWalkerParser
-from utils.operation import image_to_base64, validate_choice_parsed, Compass
+from utils.operation import image_to_base64, jpeg_to_base64, validate_choice_parsed, Compass
 from utils.items import (
     ViewPoint, ViewPointAttrToUpdate,
     StopReactNode, ChoiceReActNode,
-    PanoItem, ViewPointPosition, PanoParams
+    ViewPointPosition, PanoParams
 )
 
+if TYPE_CHECKING:
+    # langchain is only imported by the agents that prompt a model.
+    from langchain_openai import ChatOpenAI
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.output_parsers import PydanticOutputParser
+    from utils.parser import CityWalkerParser
+
+# failed requests, re-raised by the observe calls instead of falling back to a default action.
+REQUEST_ERRORS = request_errors()
+
+# perspective observation of a stop step whose speculative perspective choice was dropped.
+SKIPPED_CHOICE = "<SKIPPED>"
+
 
 class SpaceAgent(ABC):
 
     def __init__(self):
         self.agent: ChatOpenAI
-        self._pano_params = PanoParams().to_dict(encode_json=True)  # noqa
-        self.stop_parser = CityWalkerParser(pydantic_object=StopReactNode)
-        self.choice_parser = CityWalkerParser(pydantic_object=ChoiceReActNode)
+        # image size and quality sent to this model, see `PayloadPolicy.for_agent`.
+        self.payload = PayloadPolicy.for_agent(type(self).__name__)
+        self._pano_params = self.payload.perspective_params(PanoParams().to_dict(encode_json=True))  # noqa
+        self._jpeg_quality = self.payload.quality
+        self.image_cache = EncodedImageCache.from_env()
+        self.perspective_store = PerspectiveStore.from_env()
+        self.response_cache = ResponseCache.from_env()
+
+        # sequential: stop-check then perspective choice.
+        # concurrent: both model calls in flight at once.
+        # speculative: concurrent, and the perspective choice is dropped once the stop-check says arrived;
+        # unless it had already finished, that step is saved with perspective_observation `SKIPPED_CHOICE`
+        # and no score.
+        self.observe_mode: Literal["sequential", "concurrent", "speculative"] = os.getenv("OBSERVE_MODE", "sequential")
+        if self.observe_mode not in ("sequential", "concurrent", "speculative"):
+            raise ValueError("OBSERVE_MODE should be one of 'sequential', 'concurrent' or 'speculative'.")
+        self._observe_workers = int(os.getenv("OBSERVE_WORKERS", 8))
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._throttle: Optional[Throttle] = None
+        self._throttle_lock = threading.Lock()
+        self._stop_parser: Optional[CityWalkerParser] = None
+        self._choice_parser: Optional[CityWalkerParser] = None
+        self._prompts: Dict[tuple, ChatPromptTemplate] = {}
 
     @property
     @abstractmethod
     def agent(self):
         pass
 
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._observe_workers, thread_name_prefix="observe")
+        return self._executor
+
+    @property
+    def dispatcher(self) -> Optional[RequestDispatcher]:
+        """
+        shared by every agent of the process, created on the first model request.
+        """
+        return RequestDispatcher.shared()
+
+    @property
+    def throttle(self) -> Throttle:
+        """
+        rate and concurrency limits of this agent, configured per agent name.
+        """
+        if self._throttle is None:
+            with self._throttle_lock:
+                if self._throttle is None:
+                    self._throttle = Throttle.from_env(type(self).__name__)
+        return self._throttle
+
     @agent.setter
     @abstractmethod
     def agent(self, value):
         pass
 
+    @property
+    def stop_parser(self) -> CityWalkerParser:
+        if self._stop_parser is None:
+            from utils.parser import CityWalkerParser
+            self._stop_parser = CityWalkerParser(pydantic_object=StopReactNode)
+        return self._stop_parser
+
+    @property
+    def choice_parser(self) -> CityWalkerParser:
+        if self._choice_parser is None:
+            from utils.parser import CityWalkerParser
+            self._choice_parser = CityWalkerParser(pydantic_object=ChoiceReActNode)
+        return self._choice_parser
+
     @abstractmethod
     def observe_and_think(self,
                           question: str,
@@ -46,21 +125,97 @@ class SpaceAgent(ABC):
                           ) -> ViewPointAttrToUpdate:
         pass
 
-    def _observe_pano(self,
-                      image: Union[str, ndarray, property],
-                      question: str,
-                      backtracked: bool = False,
-                      pred_action_on_start: int = 0
-                      ) -> StopReactNode:
-        image_dict = {
-            "image_url": image_to_base64(image)
+    @property
+    def model_name(self) -> str:
+        # served model names are shared across models (e.g. vllm serves every model as chatgpt-4o).
+        return f"{type(self).__name__}/{getattr(self.agent, 'model_name', None)}"
+
+    def _invoke(self,
+                prompt: ChatPromptTemplate,
+                params: dict,
+                parser: PydanticOutputParser):
+        """
+        render the prompt, get the raw completion from the model or the response cache, then parse it.
+        """
+        messages = prompt.invoke(params).to_messages()
+        images, size = PayloadPolicy.request_size(messages)
+        logger.info(f"Request with {images} images, {size / 1024:.0f} KB.")
+
+        if self.response_cache is None:
+            completion = self._complete(messages)
+        else:
+            key = ResponseCache.make_key(self.model_name, messages)
+            if self.response_cache.mode == "replay":
+                completion = self.response_cache.get(key)
+                if completion is None:
+                    raise ResponseCacheMiss(f"No recorded response for request {key}.")
+            else:
+                completion = self._complete(messages)
+                self.response_cache.put(key, self.model_name, completion)
+
+        return parser.parse(completion)
+
+    def _complete(self, messages: list) -> str:
+        """
+        raw completion of the model, through the dispatcher when it is enabled. Transport and rate limit errors
+        are retried by the throttle, then raised as `ModelUnavailable`.
+        """
+        if self.dispatcher is None:
+            return self.throttle.call(lambda: self.agent.invoke(messages).content)
+
+        return self.throttle.call(lambda: self.dispatcher.call(lambda: self.agent.ainvoke(messages)).content)
+
+    def _encode_pano(self, filename: str) -> str:
+        key = EncodedImageCache.make_key(filename, None, self.payload.pano_params, self._jpeg_quality)
+
+        return self.image_cache.get_or_create(
+            key, lambda: self._load_precomputed(key) or image_to_base64(
+                PayloadPolicy.resize(PanoVisualizer.PANO, self.payload.pano_width), quality=self._jpeg_quality
+            )
+        )
+
+    def _encode_perspective(self, filename: str, heading: float) -> str:
+        key = EncodedImageCache.make_key(filename, heading, self._pano_params, self._jpeg_quality)
+
+        return self.image_cache.get_or_create(
+            key, lambda: self._load_precomputed(key) or image_to_base64(
+                PanoVisualizer.get_perspective(theta=heading, **self._pano_params).perspective,
+                quality=self._jpeg_quality
+            )
+        )
+
+    def _encode_perspectives(self, filename: str, walkable_headings: List[float]) -> Dict[str, str]:
+        return {
+            ascii_uppercase[idx]: self._encode_perspective(filename, heading)
+            for idx, heading in enumerate(walkable_headings)
         }
+
+    def _load_precomputed(self, key: str) -> Optional[str]:
+        if self.perspective_store is None:
+            return None
+        buffer = self.perspective_store.get(key)
+
+        return None if buffer is None else jpeg_to_base64(buffer)
+
+    def _prompt(self, key: tuple, build: Callable[[], ChatPromptTemplate]) -> ChatPromptTemplate:
+        """
+        prompt templates are compiled once per agent and shape, only the step variables are bound per call.
+        """
+        prompt = self._prompts.get(key)
+        if prompt is None:
+            prompt = self._prompts.setdefault(key, build())
+        return prompt
+
+    def _build_stop_prompt(self) -> ChatPromptTemplate:
+        from langchain_core.prompts import ChatPromptTemplate
+
         str_content = [
             {
                 "type": "image_url", "image_url": {"url": "{image_url}"}
             }
         ]
-        stop_prompt = ChatPromptTemplate.from_messages(
+
+        return ChatPromptTemplate.from_messages(
             [
                 ("user", "#Instrunction:\nYou are a helpful robot to analyse images according peoples' question and help people "
                            "find the correct way to their destination, like find a bookstore and so on. Given the "
@@ -96,9 +251,80 @@ class SpaceAgent(ABC):
                 ("user", "{backtrack_prompt}"),
                 ("user", str_content)
             ]
-        )
+        ).partial(format_instructions=self.stop_parser.get_format_instructions())
+
+    def _build_choice_prompt(self,
+                             num_images: int,
+                             backtrack: bool = False,
+                             retrieve: bool = False,
+                             history: bool = False) -> ChatPromptTemplate:
+        """
+        :param num_images: number of perspectives, one image placeholder each
+        :param backtrack: ask for the perspective index given after a backtrack
+        :param retrieve: include the retrieved surrounding information
+        :param history: include the visited history nodes
+        """
+        from langchain_core.prompts import ChatPromptTemplate
+
+        str_content = [
+            {"type": "image_url", "image_url": {"url": f"{{{ascii_uppercase[idx]}}}"}} for idx in range(num_images)
+        ]
+
+        return ChatPromptTemplate.from_messages(
+            [
+                ("user", "#Instrunction:\nYou are a helpful robot to analyse images according peoples' question and help people "
+                         "find the correct way to their destination, like find a bookstore and so on."
+                         "Given the question, you should point out that which image is the most suitable as the answer using "
+                         "its index like 0 with confidence score [0, 1]]."),
+                ("user", "#Output Format:\n{format_instructions}"),
+                ("user", """
+                #Example:
+                ##Input:
+                    [
+                        {{'type': 'text', 'text': 'I am hungry'}},
+                        {{'type': 'image_url', 'image_url': '...'}},
+                        {{'type': 'image_url', 'image_url': '...'}},
+                    ]
+                ##Output:
+                    {{
+                        "thoughts": "I am hungry, so I want to find the most potential road to go."
+                        "observation": {{
+                            "A": "there are a lot of cars.",
+                            "B": "there are a lot of buildings."
+                        }}
+                        "action": "A",
+                        "score": 0.78
+                    }}
+
+                # Now here it's your turn to help answer the question and output the index of the proper image.
+                ## Input:\n"""),
+                ("user", "Do attention that the action stands for the index of image, it starts from A, A for the first image, and B for the second image"),
+                ("user", "{perspective_prompt}, your observations output should have the same num with the perspectives"),
+                ("user", "{direction_prompt}"),
+                ("user", "give more opportunities to the way on the FRONT, LEFT, RIGHT side of you, try less or even do not step BACK"),
+                ("user", "you just backtracked, and you should select the correct image index {index}") if backtrack else '',  # TODO optimize prompt
+                ("user", "For the same question, I have previously visited this location multiple rounds, gathered surrounding information, recorded my choices, and noted whether I ultimately reached the destination: {surrounding_prompt}" if retrieve else ''),  # TODO optimize prompt
+                ("user", "The historical trajectory of my visits includes: {history_nodes_prompt}" if history else ''),  # TODO
+
+
+                ("user", "{query}"),
+                ("user", str_content),
+                ("user", " ##Output:")
+            ]
+        ).partial(format_instructions=self.choice_parser.get_format_instructions())
 
-        chain = stop_prompt | self.agent | self.stop_parser
+    def _observe_pano(self,
+                      image: Union[str, ndarray, property],
+                      question: str,
+                      backtracked: bool = False,
+                      pred_action_on_start: int = 0
+                      ) -> StopReactNode:
+        image_dict = self.payload.fit({
+            "image_url": image if isinstance(image, str) else image_to_base64(
+                PayloadPolicy.resize(image, self.payload.pano_width), quality=self._jpeg_quality
+            )
+        })
+        stop_prompt = self._prompt(("stop",), self._build_stop_prompt)
 
         if backtracked:
             backtrack_prompt = f"Currently you just backtracked from image {ascii_uppercase[pred_action_on_start]}"
@@ -108,13 +334,15 @@ class SpaceAgent(ABC):
         params = {
             "query": question,
             "backtrack_prompt": backtrack_prompt,
-            "format_instructions": self.stop_parser.get_format_instructions()
         }
         params.update(image_dict)
 
         try:
-            stop_react: StopReactNode = chain.invoke(params)
+            stop_react: StopReactNode = self._invoke(stop_prompt, params, self.stop_parser)
             return stop_react
+        except (ResponseCacheMiss,) + REQUEST_ERRORS:
+            # only unparsable completions fall back to a default action.
+            raise
         except Exception as e:
 
             logger.error(f"Parsing failed: {str(e)}, set default value.")
@@ -132,83 +360,48 @@ class SpaceAgent(ABC):
                              question: str,
                              last_position: Optional[ViewPointPosition] = None,
                              curr_position: ViewPointPosition = None,
+                             images: Optional[Dict[str, str]] = None,
                              **kwargs
                              ) -> ChoiceReActNode:
+        """
+        :param images: encoded perspectives indexed by A, B, C..., rendered from the current pano when not given.
+        """
+        if images is None:
+            images = self._encode_perspectives(PanoVisualizer.FILENAME, walkable_headings)
+
         forward_azimuth = 0
         if last_position:
             forward_azimuth = Compass.get_step_forward_azimuth(last_position, curr_position)
 
-        images: List[PanoItem] = [
-            PanoVisualizer.get_perspective(theta=heading, **self._pano_params)
-            for heading in walkable_headings
-        ]
-
-        str_content = []
         image_dict = {}
         direction_prompt = {}
 
-        for idx, image in enumerate(images):
+        directions = Compass.get_relative_directions(forward_azimuth, walkable_headings) if last_position else []
+        for idx, heading in enumerate(walkable_headings):
             image_idx = f"{ascii_uppercase[idx]}"
-            str_content.append({"type": "image_url", "image_url": {"url": f"{{{image_idx}}}"}})
             if last_position:
-                direction_prompt[
-                    f"{image_idx}"] = f"This perspective is on your {Compass.get_relative_direction(forward_azimuth, walkable_headings[idx]).value}"
-            image_dict[image_idx] = image_to_base64(image.perspective)
+                direction_prompt[f"{image_idx}"] = f"This perspective is on your {directions[idx].value}"
+            image_dict[image_idx] = images[image_idx]
+
+        image_dict = self.payload.fit(image_dict)
 
         perspective_prompt = f"Here are {len(walkable_headings)} perspectives."
         logger.info(perspective_prompt)
 
-        choice_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("user", "#Instrunction:\nYou are a helpful robot to analyse images according peoples' question and help people "
-                         "find the correct way to their destination, like find a bookstore and so on."
-                         "Given the question, you should point out that which image is the most suitable as the answer using "
-                         "its index like 0 with confidence score [0, 1]]."),
-                ("user", "#Output Format:\n{format_instructions}"),
-                ("user", """
-                #Example:
-                ##Input:
-                    [
-                        {{'type': 'text', 'text': 'I am hungry'}},
-                        {{'type': 'image_url', 'image_url': '...'}},
-                        {{'type': 'image_url', 'image_url': '...'}},
-                    ]
-                ##Output:
-                    {{
-                        "thoughts": "I am hungry, so I want to find the most potential road to go."
-                        "observation": {{
-                            "A": "there are a lot of cars.",
-                            "B": "there are a lot of buildings."
-                        }}
-                        "action": "A",
-                        "score": 0.78
-                    }}
-
-                # Now here it's your turn to help answer the question and output the index of the proper image.
-                ## Input:\n"""),
-                ("user", "Do attention that the action stands for the index of image, it starts from A, A for the first image, and B for the second image"),
-                ("user", "{perspective_prompt}, your observations output should have the same num with the perspectives"),
-                ("user", "{direction_prompt}"),
-                ("user", "give more opportunities to the way on the FRONT, LEFT, RIGHT side of you, try less or even do not step BACK"),
-                ("user", "you just backtracked, and you should select the correct image index {index}") if kwargs["backtracked"] == True else '',  # TODO optimize prompt
-                ("user", "For the same question, I have previously visited this location multiple rounds, gathered surrounding information, recorded my choices, and noted whether I ultimately reached the destination: {surrounding_prompt}" if "retrieved_information" in kwargs.keys() else ''),  # TODO optimize prompt
-                ("user", "The historical trajectory of my visits includes: {history_nodes_prompt}" if "history_nodes" in kwargs.keys() else ''),  # TODO
-
-
-                ("user", "{query}"),
-                ("user", str_content),
-                ("user", " ##Output:")
-            ]
+        backtrack = kwargs["backtracked"] == True and kwargs.get("prompt_perspective_idx") is not None  # noqa
+        choice_prompt = self._prompt(
+            ("choice", len(walkable_headings), backtrack, "retrieved_information" in kwargs, "history_nodes" in kwargs),
+            lambda: self._build_choice_prompt(len(walkable_headings), backtrack,
+                                              retrieve="retrieved_information" in kwargs,
+                                              history="history_nodes" in kwargs)
         )
-        chain = choice_prompt | self.agent | self.choice_parser
 
         params = {
             "query": question,
             "perspective_prompt": perspective_prompt,
             "direction_prompt": direction_prompt,
-            "format_instructions": self.choice_parser.get_format_instructions(),
         }
-        if kwargs["backtracked"]:
+        if kwargs["backtracked"] and kwargs.get("prompt_perspective_idx") is not None:
             params.update({
                 "index": kwargs["prompt_perspective_idx"]
             })
@@ -226,11 +419,14 @@ class SpaceAgent(ABC):
         params.update(image_dict)
 
         try:
-            choice_react: ChoiceReActNode = chain.invoke(params)
+            choice_react: ChoiceReActNode = self._invoke(choice_prompt, params, self.choice_parser)
             choice_react = validate_choice_parsed(choice_react, len(walkable_headings))
 
             return choice_react
 
+        except (ResponseCacheMiss,) + REQUEST_ERRORS:
+            # only unparsable completions fall back to a default action.
+            raise
         except Exception as e:
 
             logger.error(f"Parsing failed: {str(e)}, set default value.")
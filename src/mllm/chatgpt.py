@@ -1,89 +1,111 @@
-import os
-import json
-
-from string import ascii_uppercase
-
-from langchain_openai import ChatOpenAI
-
-from src.mllm.agent import SpaceAgent
-from utils.operation import Compass
-from utils.panovis import PanoVisualizer
-from utils.items import ViewPoint, ViewPointAttrToUpdate, VisitStatus, StopStatus, ViewPointPosition
-
-
-# class ChatGPT4o(SpaceAgent):
-
-#     OPENAI_API_BASE = os.getenv("OPENAI_API_BASE")
-#     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
-#     def __init__(self):
-#         super().__init__()
-
-#         self._agent = ChatOpenAI(model_name="chatgpt-4o",
-#                                  openai_api_key=self.OPENAI_API_KEY,
-#                                  openai_api_base=self.OPENAI_API_BASE)
-
-class ChatGPT4o(SpaceAgent):
-
-    OPENAI_API_BASE = os.getenv("OPENAI_API_BASE")
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    MODEL_NAME = os.getenv("MODEL_NAME")
-   
-    def __init__(self):
-        super().__init__()
-        print(self.OPENAI_API_BASE)
-        print(self.MODEL_NAME)
-        # import pdb
-        # pdb.set_trace()
-        self._agent = ChatOpenAI(model_name=self.MODEL_NAME,
-                                 api_key=self.OPENAI_API_KEY,
-                                 base_url=self.OPENAI_API_BASE)
-    @property
-    def agent(self):
-        return self._agent
-
-    def observe_and_think(self,
-                          question: str,
-                          viewpoint: ViewPoint,
-                          last_position: ViewPointPosition = None,
-                          curr_position: ViewPointPosition = None,
-                          last_forward_azimuth: float = None,
-                          **kwargs
-                          ) -> ViewPointAttrToUpdate:
-        PanoVisualizer.set_pano(viewpoint.filename)
-        PanoVisualizer.set_heading(viewpoint.heading)
-
-        pano_react = self._observe_pano(PanoVisualizer.PANO, question)
-        choice_react = self._observe_perspective(
-            viewpoint.walkable_headings, question,
-            last_position, curr_position, **kwargs
-        )
-
-        # neo4j can not store map values.
-        if isinstance(choice_react.observation, dict):
-            choice_react.observation = json.dumps(choice_react.observation)
-
-        if isinstance(pano_react.observation, dict):
-            pano_react.observation = json.dumps(pano_react.observation)
-
-        if pano_react.action == StopStatus.STOP.value:  # if stopped
-            action = StopStatus.STOP.REACHED.value
-        else:
-            action = ascii_uppercase.index(choice_react.action.upper())
-
-        if last_position:
-            direction = Compass.get_relative_direction(last_forward_azimuth,
-                                                       viewpoint.walkable_headings[pano_react.action]).value
-        else:
-            direction = "<START>"
-
-        return ViewPointAttrToUpdate(
-            filename=viewpoint.filename,
-            observations=pano_react.observation,
-            perspective_observation=choice_react.observation,
-            thought=pano_react.thoughts,
-            score=choice_react.score,
-            pred_action=action,
-            visited=VisitStatus.CURRENT_VISITED,
-            action_direction=direction
-        )
+import os
+import json
+
+from string import ascii_uppercase
+
+from langchain_openai import ChatOpenAI
+
+from src.mllm.agent import SpaceAgent, SKIPPED_CHOICE
+from src.mllm.http_pool import HttpPool
+from utils.operation import Compass
+from utils.map_logger import logger
+from utils.panovis import PanoVisualizer
+from utils.items import ViewPoint, ViewPointAttrToUpdate, VisitStatus, StopStatus, ViewPointPosition
+
+
+# class ChatGPT4o(SpaceAgent):
+
+#     OPENAI_API_BASE = os.getenv("OPENAI_API_BASE")
+#     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+#     def __init__(self):
+#         super().__init__()
+
+#         self._agent = ChatOpenAI(model_name="chatgpt-4o",
+#                                  openai_api_key=self.OPENAI_API_KEY,
+#                                  openai_api_base=self.OPENAI_API_BASE)
+
+class ChatGPT4o(SpaceAgent):
+
+    OPENAI_API_BASE = os.getenv("OPENAI_API_BASE")
+    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+    MODEL_NAME = os.getenv("MODEL_NAME")
+   
+    def __init__(self):
+        super().__init__()
+        logger.debug(f"{self.MODEL_NAME} served by {self.OPENAI_API_BASE}")
+        # retries are left to the throttle, which also adapts the concurrency to rate limits.
+        # every agent of the process shares the same connection pool.
+        pool = HttpPool.shared()
+        self._agent = ChatOpenAI(model_name=self.MODEL_NAME,
+                                 api_key=self.OPENAI_API_KEY,
+                                 base_url=self.OPENAI_API_BASE,
+                                 max_retries=0,
+                                 http_client=pool.client,
+                                 http_async_client=pool.async_client)
+    @property
+    def agent(self):
+        return self._agent
+
+    def observe_and_think(self,
+                          question: str,
+                          viewpoint: ViewPoint,
+                          last_position: ViewPointPosition = None,
+                          curr_position: ViewPointPosition = None,
+                          last_forward_azimuth: float = None,
+                          **kwargs
+                          ) -> ViewPointAttrToUpdate:
+        PanoVisualizer.select_pano(viewpoint.filename, viewpoint.heading)
+        pano_image = self._encode_pano(viewpoint.filename)
+
+        if self.observe_mode == "sequential":
+            pano_react = self._observe_pano(pano_image, question)
+            choice_react = self._observe_perspective(
+                viewpoint.walkable_headings, question,
+                last_position, curr_position, **kwargs
+            )
+        else:
+            # perspectives are rendered on this thread, the pano of the viewpoint is thread local.
+            images = self._encode_perspectives(viewpoint.filename, viewpoint.walkable_headings)
+            choice_future = self.executor.submit(
+                self._observe_perspective, viewpoint.walkable_headings, question,
+                last_position, curr_position, images=images, **kwargs
+            )
+            pano_react = self._observe_pano(pano_image, question)
+
+            # a choice that already finished is kept, so the stop step is recorded as in the other modes.
+            if self.observe_mode == "speculative" and pano_react.action == StopStatus.STOP.value and not (
+                    choice_future.done() and choice_future.exception() is None):
+                choice_future.cancel()  # ignored if the request is already in flight
+                choice_react = None
+            else:
+                choice_react = choice_future.result()
+
+        # neo4j can not store map values.
+        if choice_react is not None and isinstance(choice_react.observation, dict):
+            choice_react.observation = json.dumps(choice_react.observation)
+
+        if isinstance(pano_react.observation, dict):
+            pano_react.observation = json.dumps(pano_react.observation)
+
+        if pano_react.action == StopStatus.STOP.value:  # if stopped
+            action = StopStatus.STOP.REACHED.value
+        else:
+            action = ascii_uppercase.index(choice_react.action.upper())
+
+        if last_position:
+            direction = Compass.get_relative_direction(last_forward_azimuth,
+                                                       viewpoint.walkable_headings[pano_react.action]).value
+        else:
+            direction = "<START>"
+
+        return ViewPointAttrToUpdate(
+            filename=viewpoint.filename,
+            observations=pano_react.observation,
+            perspective_observation=choice_react.observation if choice_react is not None else SKIPPED_CHOICE,
+            thought=pano_react.thoughts,
+            score=choice_react.score if choice_react is not None else None,
+            pred_action=action,
+            visited=VisitStatus.CURRENT_VISITED,
+            action_direction=direction
+        )
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import os
+import atexit
+import asyncio
+import threading
+
+from concurrent.futures import Future
+from typing import Optional, Callable, Awaitable, TypeVar
+
+from utils.map_logger import logger
+from src.mllm.http_pool import HttpPool
+
+T = TypeVar("T")
+
+
+class RequestDispatcher:
+    """
+    Runs the model requests of every episode thread on one background event loop.
+    Up to `max_in_flight` requests are awaited at once, so a batching server (vllm) sees them together.
+    Submitting blocks while `max_pending` requests are queued or in flight, and every request is
+    cancelled after `timeout` seconds. Each caller gets a future resolved with its own completion.
+    """
+
+    _shared: Optional[RequestDispatcher] = None
+    _shared_loaded = False
+    _lock = threading.Lock()
+
+    def __init__(self, max_in_flight: int = 32, max_pending: Optional[int] = None, timeout: Optional[float] = 120.0):
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending or 4 * max_in_flight
+        self.timeout = timeout
+
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="dispatcher", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls) -> Optional[RequestDispatcher]:
+        """
+        DISPATCH_MAX_IN_FLIGHT (0, the default, calls the model on the episode thread), DISPATCH_MAX_PENDING,
+        DISPATCH_TIMEOUT. Worth enabling with concurrent episodes.
+        """
+        max_in_flight = int(os.getenv("DISPATCH_MAX_IN_FLIGHT", 0))
+        if max_in_flight <= 0:
+            return None
+        max_pending = os.getenv("DISPATCH_MAX_PENDING")
+        timeout = float(os.getenv("DISPATCH_TIMEOUT", 120))
+
+        return cls(max_in_flight=max_in_flight,
+                   max_pending=int(max_pending) if max_pending else None,
+                   timeout=timeout if timeout > 0 else None)
+
+    @classmethod
+    def shared(cls) -> Optional[RequestDispatcher]:
+        """
+        process-wide dispatcher, so that the shared async http client is only used from one event loop.
+        """
+        if not cls._shared_loaded:
+            with cls._lock:
+                if not cls._shared_loaded:
+                    cls._shared = cls.from_env()
+                    cls._shared_loaded = True
+        return cls._shared
+
+    def submit(self, call: Callable[[], Awaitable[T]], timeout: Optional[float] = None) -> Future:
+        """
+        schedule `call()` on the event loop, blocks while the dispatcher is full.
+
+        :param call: builds the coroutine, only called once a slot is free
+        :param timeout: seconds before the request is cancelled, `self.timeout` by default
+        """
+        self._pending.acquire()
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._run(call, timeout or self.timeout), self._loop)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+
+        return future
+
+    def call(self, call: Callable[[], Awaitable[T]], timeout: Optional[float] = None) -> T:
+        return self.submit(call, timeout=timeout).result()
+
+    async def _run(self, call: Callable[[], Awaitable[T]], timeout: Optional[float]) -> T:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                result = await asyncio.wait_for(call(), timeout)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                raise TimeoutError(f"Model request did not complete within {timeout}s.")
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self.in_flight -= 1
+            self.completed += 1
+
+            return result
+
+    def close(self) -> None:
+        if not self._loop.is_running():
+            return
+        # the pooled async connections belong to this loop, so they are closed on it before it stops.
+        try:
+            asyncio.run_coroutine_threadsafe(HttpPool.aclose_shared(), self._loop).result(timeout=10)
+        except Exception as e:
+            logger.warning(f"Failed to close the async http client: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        logger.debug(f"Dispatcher closed after {self.completed} requests, "
+                     f"{self.failed} failed and {self.timed_out} timed out.")
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import os
+import time
+import atexit
+import threading
+import importlib.util
+
+from typing import Optional, Callable, TYPE_CHECKING
+
+from utils.map_logger import logger
+
+if TYPE_CHECKING:
+    import httpx
+
+
+class ConnectionStats:
+    """
+    counters fed by the httpcore trace of every request: requests sent, new TCP connections,
+    TLS handshakes and the time spent opening them. Requests without a new connection reused one.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.handshakes = 0
+        self.connect_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def tracer(self) -> Callable[[str], None]:
+        """
+        counts one request and returns the trace callback of that request.
+        """
+        with self._lock:
+            self.requests += 1
+        started = []
+
+        def on_trace(event: str) -> None:
+            if event in ("connection.connect_tcp.started", "connection.start_tls.started"):
+                started.append(time.perf_counter())
+                return
+            if event not in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                return
+            with self._lock:
+                if event == "connection.connect_tcp.complete":
+                    self.connections += 1
+                else:
+                    self.handshakes += 1
+                if started:
+                    self.connect_seconds += time.perf_counter() - started.pop()
+
+        return on_trace
+
+    @property
+    def reused(self) -> int:
+        return max(self.requests - self.connections, 0)
+
+    def summary(self) -> str:
+        return (f"{self.requests} requests over {self.connections} connections "
+                f"({self.reused} reused, {self.handshakes} TLS handshakes, {self.connect_seconds:.2f}s connecting)")
+
+
+class HttpPool:
+    """
+    Process-wide httpx clients shared by every agent, so requests reuse keep-alive (and HTTP/2 when
+    `h2` is installed) connections instead of opening a pool per agent. Configured from env:
+    HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_KEEPALIVE_EXPIRY, HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT and HTTP2.
+    """
+
+    _shared: Optional[HttpPool] = None
+    _lock = threading.Lock()
+
+    def __init__(self,
+                 max_connections: int = 100,
+                 max_keepalive: int = 20,
+                 keepalive_expiry: float = 30.0,
+                 connect_timeout: float = 10.0,
+                 timeout: float = 120.0,
+                 http2: bool = False):
+        import httpx
+
+        self.http2 = http2
+        self.stats = ConnectionStats()
+
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=max_keepalive,
+                              keepalive_expiry=keepalive_expiry)
+        timeouts = httpx.Timeout(timeout, connect=connect_timeout)
+
+        def on_request(request: httpx.Request) -> None:
+            on_trace = self.stats.tracer()
+            request.extensions["trace"] = lambda event, info: on_trace(event)
+
+        async def on_async_request(request: httpx.Request) -> None:
+            on_trace = self.stats.tracer()
+
+            async def trace(event: str, info: dict) -> None:
+                on_trace(event)
+
+            request.extensions["trace"] = trace
+
+        self.client = httpx.Client(limits=limits, timeout=timeouts, http2=http2,
+                                   event_hooks={"request": [on_request]})
+        self.async_client = httpx.AsyncClient(limits=limits, timeout=timeouts, http2=http2,
+                                              event_hooks={"request": [on_async_request]})
+
+    @classmethod
+    def from_env(cls) -> HttpPool:
+        http2 = os.getenv("HTTP2", "auto")
+        h2_installed = importlib.util.find_spec("h2") is not None
+        if http2 == "1" and not h2_installed:
+            logger.warning("HTTP2=1 but the h2 package is not installed, falling back to HTTP/1.1.")
+
+        return cls(
+            max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", 100)),
+            max_keepalive=int(os.getenv("HTTP_MAX_KEEPALIVE", 20)),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30)),
+            connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", 10)),
+            timeout=float(os.getenv("HTTP_TIMEOUT", 120)),
+            http2=h2_installed and http2 != "0",
+        )
+
+    @classmethod
+    def shared(cls) -> HttpPool:
+        if cls._shared is None:
+            with cls._lock:
+                if cls._shared is None:
+                    cls._shared = cls.from_env()
+                    atexit.register(cls._shared.close)
+        return cls._shared
+
+    @classmethod
+    async def aclose_shared(cls) -> None:
+        """
+        close the async client of the shared pool, awaited on the event loop that used it.
+        """
+        if cls._shared is not None:
+            await cls._shared.async_client.aclose()
+
+    def close(self) -> None:
+        """
+        close the sync client, the async one is closed by the dispatcher on its event loop (`aclose_shared`).
+        """
+        if self.stats.requests:
+            logger.info(f"HTTP pool{' (HTTP/2)' if self.http2 else ''}: {self.stats.summary()}.")
+        self.client.close()
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import importlib
+
+from typing import Dict, Type, Union, TYPE_CHECKING
+
+from utils.items import MultiModels
+
+if TYPE_CHECKING:
+    from src.mllm.agent import SpaceAgent
+
+
+# module defining each space agent, only the module of the selected agent is imported.
+_AGENT_MODULES: Dict[str, str] = {
+    MultiModels.ChatGPT4o.name: "src.mllm.chatgpt",
+    MultiModels.StraightBaselineModel.name: "src.mllm.straight",
+    MultiModels.RandomBaselineModel.name: "src.mllm.random",
+}
+_DEFAULT_MODULE = "src.mllm.all_models"
+
+
+def resolve_agent(agent: Union[MultiModels, str]) -> Type[SpaceAgent]:
+    """
+    :param agent: member or name of `MultiModels`
+    :return: the `SpaceAgent` subclass, importing only its own module
+    """
+    name = agent.value if isinstance(agent, MultiModels) else MultiModels[agent].value
+    module = importlib.import_module(_AGENT_MODULES.get(name, _DEFAULT_MODULE))
+
+    return getattr(module, name)
+
+
+def create_agent(agent: Union[MultiModels, str]) -> SpaceAgent:
+    return resolve_agent(agent)()
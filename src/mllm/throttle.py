@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import os
+import time
+import random
+import threading
+
+from typing import Optional, Tuple, Type, Literal
+
+from utils.map_logger import logger
+
+
+class ModelUnavailable(RuntimeError):
+    """
+    the model request kept failing on transport or rate limit errors, raised instead of a default action.
+    """
+
+
+def transient_errors() -> Tuple[Type[BaseException], ...]:
+    """
+    errors worth retrying: rate limits, connection failures and timeouts, server errors.
+    """
+    errors = (TimeoutError, ConnectionError)
+    try:
+        from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+    except ImportError:
+        return errors
+
+    return errors + (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+def request_errors() -> Tuple[Type[BaseException], ...]:
+    """
+    errors of the request itself rather than of its completion: retries ran out, the api refused it
+    (bad key, unknown model, oversized payload) or the transport failed. Raised, never turned into a default action.
+    """
+    errors = (ModelUnavailable,)
+    try:
+        from openai import APIError
+        errors += (APIError,)
+    except ImportError:
+        pass
+    try:
+        from httpx import HTTPError
+        errors += (HTTPError,)
+    except ImportError:
+        pass
+
+    return errors
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    seconds asked by the provider in the `retry-after(-ms)` header of the error response, if any.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+
+    return None
+
+
+class TokenBucket:
+    """
+    `rate` requests per second with bursts of up to `burst` requests, shared by every thread of the agent.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        take a token, possibly borrowed from the future, and return how long to wait for it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> None:
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on the requests in flight: +1 per window of successful requests, halved on a rate limit
+    (at most once per `cooldown` seconds, so one burst of 429s only counts once).
+    """
+
+    def __init__(self,
+                 maximum: int,
+                 initial: Optional[int] = None,
+                 minimum: int = 1,
+                 decrease: float = 0.5,
+                 cooldown: float = 1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(min(initial or maximum, maximum))
+        self.in_flight = 0
+
+        self._decreased = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, outcome: Literal["success", "overload", "error"]) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == "success":
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            elif outcome == "overload" and time.monotonic() - self._decreased > self.cooldown:
+                self.limit = max(float(self.minimum), self.limit * self.decrease)
+                self._decreased = time.monotonic()
+                logger.warning(f"Rate limited, concurrency lowered to {int(self.limit)}.")
+            self._condition.notify_all()
+
+
+class Throttle:
+    """
+    Token bucket and adaptive concurrency in front of the model requests of one agent, with retries
+    and exponential backoff on transient errors.
+    """
+
+    def __init__(self,
+                 bucket: Optional[TokenBucket],
+                 concurrency: AdaptiveConcurrency,
+                 max_retries: int = 6,
+                 backoff: float = 1.0,
+                 max_backoff: float = 60.0):
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._transient = transient_errors()
+
+    @classmethod
+    def _setting(cls, name: str, model: str, default: float) -> float:
+        value = os.getenv(f"{name}_{model}", os.getenv(name))
+        return default if value in (None, "") else float(value)
+
+    @classmethod
+    def from_env(cls, model: str) -> Throttle:
+        """
+        RATE_LIMIT (requests per second, 0 for none), RATE_BURST, MAX_CONCURRENCY, INITIAL_CONCURRENCY,
+        MODEL_MAX_RETRIES, RETRY_BACKOFF and RETRY_BACKOFF_MAX, each overridden for one agent by
+        the same variable suffixed with its name, e.g. RATE_LIMIT_gemini_1_5_pro=2.
+        """
+        rate = cls._setting("RATE_LIMIT", model, 0)
+        maximum = int(cls._setting("MAX_CONCURRENCY", model, int(os.getenv("DISPATCH_MAX_IN_FLIGHT", 0)) or 32))
+
+        return cls(
+            bucket=TokenBucket(rate, burst=cls._setting("RATE_BURST", model, max(rate, 1))) if rate > 0 else None,
+            concurrency=AdaptiveConcurrency(maximum, initial=int(cls._setting("INITIAL_CONCURRENCY", model, maximum))),
+            max_retries=int(cls._setting("MODEL_MAX_RETRIES", model, 6)),
+            backoff=cls._setting("RETRY_BACKOFF", model, 1.0),
+            max_backoff=cls._setting("RETRY_BACKOFF_MAX", model, 60.0),
+        )
+
+    def call(self, request):
+        """
+        run `request()` within the limits, retrying transient errors.
+        :raise ModelUnavailable: once every retry failed
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            self.concurrency.acquire()
+            try:
+                result = request()
+            except self._transient as e:
+                rate_limited = is_rate_limited(e)
+                self.concurrency.release("overload" if rate_limited else "error")
+                if attempt == self.max_retries:
+                    raise ModelUnavailable(f"Model request failed after {attempt + 1} attempts: {e}") from e
+                # full jitter, unless the provider says when to come back.
+                delay = retry_after(e) or random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                logger.warning(f"{type(e).__name__} on model request, retry {attempt + 1}/{self.max_retries} "
+                               f"in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.concurrency.release("error")
+                raise
+            self.concurrency.release("success")
+
+            return result
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+from pathlib import Path
+from collections import OrderedDict
+from typing import Optional, Callable, Union, Literal, List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+
+class EncodedImageCache:
+    """
+    Content-addressed cache of the `data:image/jpeg;base64,...` strings sent to the model.
+    Entries are kept in an in-memory LRU, backed by an optional sqlite file (one per city).
+    """
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, capacity: int = 512):
+        self.capacity = capacity
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+        if path is not None:
+            Path(path).parent.mkdir(exist_ok=True, parents=True)
+            self._db = sqlite3.connect(Path(path).as_posix(), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS images (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls) -> EncodedImageCache:
+        """
+        IMAGE_CACHE_DIR enables the on-disk tier, stored as `<IMAGE_CACHE_DIR>/<CITY_NAME>.sqlite`.
+        """
+        cache_dir = os.getenv("IMAGE_CACHE_DIR")
+        path = Path(cache_dir) / f"{os.getenv('CITY_NAME', 'default')}.sqlite" if cache_dir else None
+
+        return cls(path=path, capacity=int(os.getenv("IMAGE_CACHE_SIZE", 512)))
+
+    @classmethod
+    def make_key(cls,
+                 filename: str,
+                 heading: Optional[float],
+                 params: dict,
+                 quality: int) -> str:
+        """
+        :param filename: pano filename
+        :param heading: perspective heading, None for the full pano
+        :param params: PanoParams used to render the perspective
+        :param quality: JPEG quality
+        """
+        payload = json.dumps({
+            "filename": filename,
+            "heading": None if heading is None else round(float(heading), 6),
+            "params": params,
+            "quality": quality
+        }, sort_keys=True)
+
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT value FROM images WHERE key = ?", (key,)).fetchone()
+
+        if row is not None:
+            self._remember(key, row[0])
+            return row[0]
+
+        return None
+
+    def put(self, key: str, value: str) -> None:
+        self._remember(key, value)
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("INSERT OR REPLACE INTO images (key, value) VALUES (?, ?)", (key, value))
+                self._db.commit()
+
+    def get_or_create(self, key: str, factory: Callable[[], str]) -> str:
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+
+        return value
+
+    def _remember(self, key: str, value: str) -> None:
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.capacity:
+                self._memory.popitem(last=False)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class ResponseCacheMiss(LookupError):
+    """
+    raised in replay mode when a request has never been recorded.
+    """
+
+
+class ResponseCache:
+    """
+    Raw model completions keyed on a hash of model name, rendered prompt messages and image digests.
+
+    passthrough: the cache is not used
+    record: every request goes to the model and its completion is stored
+    replay: completions are served from the cache only, a miss raises `ResponseCacheMiss`
+    """
+
+    def __init__(self,
+                 path: Union[str, Path],
+                 mode: Literal["passthrough", "record", "replay"] = "passthrough"):
+        if mode not in ("passthrough", "record", "replay"):
+            raise ValueError("mode should be one of 'passthrough', 'record' or 'replay'.")
+        self.mode = mode
+        self._lock = threading.Lock()
+
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self._db = sqlite3.connect(Path(path).as_posix(), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT NOT NULL, completion TEXT NOT NULL)"
+        )
+        self._db.commit()
+
+    @classmethod
+    def from_env(cls) -> Optional[ResponseCache]:
+        """
+        VLM_CACHE_MODE selects the mode, VLM_CACHE_PATH the sqlite file.
+        """
+        mode = os.getenv("VLM_CACHE_MODE", "passthrough")
+        if mode == "passthrough":
+            return None
+        path = os.getenv("VLM_CACHE_PATH") or Path(__file__).parent.parent / "output_dir" / "vlm_responses.sqlite"
+
+        return cls(path=path, mode=mode)
+
+    @classmethod
+    def _digest_content(cls, content: Union[str, list]) -> Union[str, list]:
+        if isinstance(content, str):
+            return content
+        parts = []
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                url = part["image_url"]["url"] if isinstance(part["image_url"], dict) else part["image_url"]
+                part = {"type": "image_url", "image_url": "sha256:" + hashlib.sha256(url.encode("utf-8")).hexdigest()}
+            parts.append(part)
+
+        return parts
+
+    @classmethod
+    def make_key(cls, model: str, messages: List[BaseMessage]) -> str:
+        payload = json.dumps({
+            "model": model,
+            "messages": [{"type": message.type, "content": cls._digest_content(message.content)}
+                         for message in messages]
+        }, sort_keys=True, ensure_ascii=False)
+
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT completion FROM responses WHERE key = ?", (key,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def put(self, key: str, model: str, completion: str) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses (key, model, completion) VALUES (?, ?, ?)",
+                             (key, model, completion))
+            self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
@@ -1,5 +1,13 @@
+from __future__ import annotations
+
 import os
-from typing import List
+import time
+import atexit
+import threading
+import numpy as np
+from collections import deque
+from queue import Queue, Empty
+from typing import List, Optional, Dict, Literal, Tuple
 from langchain_neo4j import Neo4jGraph
 
 from utils.map_logger import logger
@@ -7,9 +15,465 @@ from utils.operation import Compass, find_closest_value
 from utils.items import ViewPointAttrToUpdate, ViewPoint, VisitStatus, ViewPointPosition, ViewPointPositionWithObservation
 
 
+class GraphSnapshot:
+    """
+    Read-only in-memory copy of all `Point` nodes and `CONNECTED_TO` edges of one database.
+    Nodes are addressed by ordinal, outgoing edges are stored as CSR arrays (`indptr`, `targets`).
+    """
+
+    _NODES_QUERY = """
+    MATCH (n:Point)
+    RETURN elementID(n) AS element_id, n.filename AS filename,
+           n.longitude AS longitude, n.latitude AS latitude,
+           n.heading AS heading, n.walkable_headings AS walkable_headings
+    """
+
+    _EDGES_QUERY = """
+    MATCH (a:Point)-[r:CONNECTED_TO]->(b:Point)
+    RETURN elementID(a) AS source, elementID(b) AS target, r.azimuth AS azimuth, r.distance AS distance
+    """
+
+    def __init__(self,
+                 element_ids: List[str],
+                 filenames: List[str],
+                 longitudes: np.ndarray,
+                 latitudes: np.ndarray,
+                 headings: np.ndarray,
+                 walkable_indptr: np.ndarray,
+                 walkable_headings: np.ndarray,
+                 indptr: np.ndarray,
+                 targets: np.ndarray,
+                 azimuths: np.ndarray,
+                 distances: np.ndarray):
+        self.element_ids = element_ids
+        self.filenames = filenames
+        self.longitudes = longitudes
+        self.latitudes = latitudes
+        self.headings = headings
+        self.walkable_indptr = walkable_indptr
+        self.walkable_headings = walkable_headings
+        self.indptr = indptr
+        self.targets = targets
+        self.azimuths = azimuths
+        self.distances = distances
+
+        self.index: Dict[str, int] = {filename: i for i, filename in enumerate(filenames)}
+        self.element_index: Dict[str, int] = {element_id: i for i, element_id in enumerate(element_ids)}
+
+        # shortestPath in cypher ignores the direction of `CONNECTED_TO`, so keep an undirected view as well.
+        self.sources = np.repeat(np.arange(len(filenames), dtype=np.int32), np.diff(indptr))
+        sources = self.sources
+        pairs = np.unique(np.concatenate([
+            np.stack([sources, targets], axis=1),
+            np.stack([targets, sources], axis=1)
+        ]), axis=0) if len(targets) else np.empty((0, 2), dtype=np.int32)
+        self.undirected_indptr = np.searchsorted(pairs[:, 0], np.arange(len(filenames) + 1)).astype(np.int32)
+        self.undirected_targets = pairs[:, 1].astype(np.int32)
+
+        # incoming edges of every node as CSR over edge positions, built on first use.
+        self._incoming: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+        # geodesic azimuth and length of every undirected edge, computed on first use.
+        self._undirected_azimuths: Optional[np.ndarray] = None
+        self._undirected_distances: Optional[np.ndarray] = None
+
+        # hop distances and path lengths in meters of every node to a target, keyed by target ordinal.
+        self._distances_to: Dict[int, np.ndarray] = {}
+        self._path_lengths_to: Dict[int, np.ndarray] = {}
+        self._distances_lock = threading.Lock()
+
+    @classmethod
+    def from_graph(cls, client: Neo4jGraph) -> GraphSnapshot:
+        nodes = client.query(cls._NODES_QUERY)
+        edges = client.query(cls._EDGES_QUERY)
+
+        element_ids = [node["element_id"] for node in nodes]
+        element_index = {element_id: i for i, element_id in enumerate(element_ids)}
+        walkable = [node["walkable_headings"] or [] for node in nodes]
+
+        sources = np.array([element_index[edge["source"]] for edge in edges], dtype=np.int32)
+        targets = np.array([element_index[edge["target"]] for edge in edges], dtype=np.int32)
+        order = np.argsort(sources, kind="stable")
+
+        return cls(
+            element_ids=element_ids,
+            filenames=[node["filename"] for node in nodes],
+            longitudes=np.array([node["longitude"] for node in nodes], dtype=np.float64),
+            latitudes=np.array([node["latitude"] for node in nodes], dtype=np.float64),
+            headings=np.array([node["heading"] for node in nodes], dtype=np.float64),
+            walkable_indptr=np.concatenate([[0], np.cumsum([len(w) for w in walkable])]).astype(np.int32),
+            walkable_headings=np.array([h for w in walkable for h in w], dtype=np.float64),
+            indptr=np.searchsorted(sources[order], np.arange(len(nodes) + 1)).astype(np.int32),
+            targets=targets[order],
+            azimuths=np.array([edge["azimuth"] for edge in edges], dtype=np.float64)[order],
+            distances=np.array([edge["distance"] for edge in edges], dtype=np.float64)[order],
+        )
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.targets)
+
+    def ordinal(self, filename: str) -> int:
+        return self.index[filename]
+
+    def position(self, ordinal: int) -> ViewPointPosition:
+        return ViewPointPosition(
+            filename=self.filenames[ordinal],
+            longitude=self.longitudes[ordinal].item(),
+            latitude=self.latitudes[ordinal].item()
+        )
+
+    def retrieve_viewpoint_from_filename(self, filename: str) -> ViewPoint:
+        i = self.index[filename]
+        return ViewPoint(
+            filename=filename,
+            heading=self.headings[i].item(),
+            walkable_headings=self.walkable_headings[self.walkable_indptr[i]: self.walkable_indptr[i + 1]].tolist()
+        )
+
+    def retrieve_viewpoint_from_element_id(self, element_id: str) -> ViewPointPosition:
+        return self.position(self.element_index[element_id])
+
+    def retrieve_edges_start_from_viewpoint(self, filename: str) -> List:
+        i = self.index[filename]
+        return [
+            {
+                "startNodeId": self.element_ids[i],
+                "endNodeId": self.element_ids[self.targets[e]],
+                "rProperties": {"azimuth": self.azimuths[e].item(), "distance": self.distances[e].item()}
+            }
+            for e in range(self.indptr[i], self.indptr[i + 1])
+        ]
+
+    def has_edge(self, source_filename: str, target_filename: str) -> bool:
+        i = self.index[source_filename]
+        return bool(np.any(self.targets[self.indptr[i]: self.indptr[i + 1]] == self.index[target_filename]))
+
+    def incident_edges(self, i: int) -> List[Tuple[int, int]]:
+        """
+        (edge position, other node ordinal) of every outgoing then incoming edge of node ordinal i.
+        """
+        if self._incoming is None:
+            order = np.argsort(self.targets, kind="stable").astype(np.int32)
+            self._incoming = (np.searchsorted(self.targets[order], np.arange(len(self) + 1)).astype(np.int32), order)
+        incoming_indptr, incoming = self._incoming
+
+        return [(e, int(self.targets[e])) for e in range(self.indptr[i], self.indptr[i + 1])] + [
+            (int(e), int(self.sources[e])) for e in incoming[incoming_indptr[i]: incoming_indptr[i + 1]]
+        ]
+
+    def get_closest_viewpoint(self, filename: str, azimuth: float) -> (ViewPointPosition, float):
+        i = self.index[filename]
+        start, end = self.indptr[i], self.indptr[i + 1]
+        if start == end:
+            raise ValueError(f"Viewpoint {filename} has no outgoing edges.")
+        e = start + int(np.argmin(np.abs(self.azimuths[start:end] - azimuth)))
+
+        return self.position(self.targets[e]), self.distances[e].item()
+
+    def _compute_geodesics(self) -> None:
+        sources = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.undirected_indptr))
+        azimuths, distances = Compass.inverse(
+            self.longitudes[sources], self.latitudes[sources],
+            self.longitudes[self.undirected_targets], self.latitudes[self.undirected_targets]
+        )
+        self._undirected_distances = distances
+        self._undirected_azimuths = azimuths
+
+    def edge_position(self, source: int, target: int) -> Optional[int]:
+        """
+        position of the undirected edge between two node ordinals, None if they are not adjacent.
+        """
+        start, end = self.undirected_indptr[source], self.undirected_indptr[source + 1]
+        position = start + int(np.searchsorted(self.undirected_targets[start:end], target))
+        if position < end and self.undirected_targets[position] == target:
+            return position
+
+        return None
+
+    def forward_azimuth(self, start_filename: str, end_filename: str) -> Optional[float]:
+        """
+        geodesic azimuth from start to end read from the per-city edge table, None if they are not adjacent.
+        """
+        position = self.edge_position(self.index[start_filename], self.index[end_filename])
+        if position is None:
+            return None
+        if self._undirected_azimuths is None:
+            self._compute_geodesics()
+
+        return self._undirected_azimuths[position].item()
+
+    def shortest_path(self, start_filename: str, end_filename: str) -> List[int]:
+        """
+        breadth-first search over the undirected graph, returns node ordinals from start to end.
+        """
+        start, end = self.index[start_filename], self.index[end_filename]
+        parents = np.full(len(self), -1, dtype=np.int32)
+        parents[start] = start
+        frontier = deque([start])
+        while frontier and parents[end] < 0:
+            node = frontier.popleft()
+            for neighbour in self.undirected_targets[self.undirected_indptr[node]: self.undirected_indptr[node + 1]]:
+                if parents[neighbour] < 0:
+                    parents[neighbour] = node
+                    frontier.append(neighbour)
+
+        if parents[end] < 0:
+            raise ValueError(f"No path between {start_filename} and {end_filename}.")
+
+        path = [end]
+        while path[-1] != start:
+            path.append(int(parents[path[-1]]))
+
+        return path[::-1]
+
+    def distances_to(self, target_filename: str) -> np.ndarray:
+        """
+        hop distance of every node to the target over the undirected graph, indexed by node ordinal,
+        -1 for unreachable nodes. Computed once per target with a level-synchronous breadth-first search.
+        """
+        target = self.index[target_filename]
+        distances = self._distances_to.get(target)
+        if distances is not None:
+            return distances
+
+        distances = np.full(len(self), -1, dtype=np.int16)
+        distances[target] = 0
+        frontier = np.array([target], dtype=np.int32)
+        level = 0
+        while frontier.size:
+            level += 1
+            if level > np.iinfo(np.int16).max:
+                raise OverflowError(f"Hop distances to {target_filename} do not fit into int16.")
+            starts = self.undirected_indptr[frontier]
+            counts = self.undirected_indptr[frontier + 1] - starts
+            # positions of all the neighbours of the frontier inside `undirected_targets`.
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            neighbours = np.unique(self.undirected_targets[offsets])
+            frontier = neighbours[distances[neighbours] < 0]
+            distances[frontier] = level
+
+        with self._distances_lock:
+            return self._distances_to.setdefault(target, distances)
+
+    def path_lengths_to(self, target_filename: str) -> np.ndarray:
+        """
+        length in meters of the shortest path of every node to the target over the undirected graph, weighted by
+        the geodesic edge lengths, inf for unreachable nodes. Label-correcting search relaxing a whole frontier at once.
+        """
+        target = self.index[target_filename]
+        lengths = self._path_lengths_to.get(target)
+        if lengths is not None:
+            return lengths
+        if self._undirected_azimuths is None:
+            self._compute_geodesics()
+
+        lengths = np.full(len(self), np.inf, dtype=np.float64)
+        lengths[target] = 0.0
+        frontier = np.array([target], dtype=np.int32)
+        while frontier.size:
+            starts = self.undirected_indptr[frontier]
+            counts = self.undirected_indptr[frontier + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            neighbours = self.undirected_targets[offsets]
+            candidates = np.repeat(lengths[frontier], counts) + self._undirected_distances[offsets]
+
+            shorter = candidates < lengths[neighbours]
+            neighbours, candidates = neighbours[shorter], candidates[shorter]
+            # keep the shortest candidate of every neighbour.
+            order = np.lexsort((candidates, neighbours))
+            neighbours, candidates = neighbours[order], candidates[order]
+            first = np.concatenate([[True], neighbours[1:] != neighbours[:-1]]) if neighbours.size else neighbours
+            frontier = neighbours[first]
+            lengths[frontier] = candidates[first]
+
+        with self._distances_lock:
+            return self._path_lengths_to.setdefault(target, lengths)
+
+    def steps_between(self, start_filename: str, end_filename: str) -> int:
+        steps = int(self.distances_to(end_filename)[self.index[start_filename]])
+        if steps < 0:
+            raise ValueError(f"No path between {start_filename} and {end_filename}.")
+
+        return steps
+
+    def next_hop(self, start_filename: str, end_filename: str) -> int:
+        """
+        ordinal of the first node after start on a shortest path to end.
+        """
+        distances = self.distances_to(end_filename)
+        start = self.index[start_filename]
+        neighbours = self.undirected_targets[self.undirected_indptr[start]: self.undirected_indptr[start + 1]]
+        closer = neighbours[distances[neighbours] == distances[start] - 1]
+        if distances[start] <= 0 or not closer.size:
+            raise ValueError(f"No next hop from {start_filename} to {end_filename}.")
+
+        return int(closer[0])
+
+
+_FLUSH = "__flush__"
+_STOP = "__stop__"
+
+
+class GraphWriteBuffer:
+    """
+    Write-behind queue for the per-step node and edge updates.
+    Queued rows are grouped by kind and written as one `UNWIND` query per kind by a background thread,
+    either when the caller marks a step / round boundary or every `flush_interval` seconds.
+    `policy="sync"` writes every mutation immediately on the caller thread, which is handy for debugging.
+    """
+
+    _QUERIES = {
+        "node_attribution": """
+        UNWIND $rows AS row
+        MATCH (n:Point {filename: row.filename})
+        SET n += row.properties
+        """,
+        "node_visited_once": """
+        UNWIND $rows AS row
+        MATCH (n:Point {filename: row.filename})
+        SET n.total_visits = coalesce(n.total_visits, 0) + 1
+        """,
+        "node_in_current_round": """
+        UNWIND $rows AS row
+        MATCH (n:Point {filename: row.filename})
+        SET n += row.properties
+        """,
+        "edge_in_current_round": """
+        UNWIND $rows AS row
+        MATCH (a:Point {filename: row.source_filename})-[r:CONNECTED_TO]->(b:Point {filename: row.target_filename})
+        SET r += row.properties
+        """,
+    }
+
+    def __init__(self,
+                 client: Neo4jGraph,
+                 policy: Literal["sync", "step", "round", "timer"] = "sync",
+                 max_pending: int = 1024,
+                 flush_interval: float = 1.0):
+        if policy not in ("sync", "step", "round", "timer"):
+            raise ValueError("policy should be one of 'sync', 'step', 'round' or 'timer'.")
+
+        self.client = client
+        self.policy = policy
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+
+        self._queue: Queue = Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._worker: Optional[threading.Thread] = None
+
+        if policy != "sync":
+            self._worker = threading.Thread(target=self._run, name="neo4j-write-behind", daemon=True)
+            self._worker.start()
+            atexit.register(self.close)
+
+    def _check_open(self) -> None:
+        if self._closed:
+            raise RuntimeError("Graph write buffer is closed, no writes can be queued.")
+
+    def submit(self, kind: str, row: dict) -> None:
+        self._check_open()
+        self._raise_worker_error()
+        if self._worker is None:
+            self._write({kind: [row]})
+        else:
+            self._queue.put((kind, row))  # blocks while the queue is full
+
+    def mark(self, boundary: Literal["step", "round"]) -> None:
+        if self.policy == boundary:
+            self.flush(wait=False)
+
+    def flush(self, wait: bool = True) -> None:
+        self._check_open()
+        if self._worker is None:
+            return
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        if wait:
+            done.wait()
+            self._raise_worker_error()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._worker is None:
+            return
+        done = threading.Event()
+        self._queue.put((_STOP, done))
+        self._worker.join()
+        self._raise_worker_error()
+
+    def _raise_worker_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Buffered neo4j write failed.") from error
+
+    def _write(self, pending: Dict[str, List[dict]]) -> None:
+        for kind, query in self._QUERIES.items():
+            rows = pending.get(kind)
+            if rows:
+                self.client.query(query, params={"rows": rows})
+
+    def _drain(self, pending: Dict[str, List[dict]]) -> None:
+        if not pending:
+            return
+        try:
+            self._write(pending)
+            logger.debug(f"Flushed {sum(len(rows) for rows in pending.values())} buffered neo4j writes.")
+        except Exception as e:
+            logger.error(f"Buffered neo4j write failed: {e}")
+            self._error = e
+        pending.clear()
+
+    def _run(self):
+        pending: Dict[str, List[dict]] = {}
+        size = 0
+        deadline = None
+        while True:
+            timeout = None
+            if self.policy == "timer" and deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                kind, payload = self._queue.get(timeout=timeout)
+            except Empty:
+                self._drain(pending)
+                size, deadline = 0, None
+                continue
+
+            if kind in (_FLUSH, _STOP):
+                self._drain(pending)
+                size, deadline = 0, None
+                payload.set()
+                if kind == _STOP:
+                    return
+                continue
+
+            pending.setdefault(kind, []).append(payload)
+            size += 1
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            if size >= self.max_pending:
+                self._drain(pending)
+                size, deadline = 0, None
+
+
 class Neo4jClient:
 
-    def __init__(self, db_name: str):
+    # node properties left out of the retrieved neighbourhoods.
+    _HIDDEN_KEYS = ['gtype', 'bbox', 'month', 'year']
+
+    def __init__(self,
+                 db_name: str,
+                 snapshot: bool = False,
+                 write_policy: Literal["sync", "step", "round", "timer"] = "sync",
+                 max_pending_writes: int = 1024,
+                 flush_interval: float = 1.0):
         params = {
             "url": os.getenv("NEO4J_URL"), #"url": "bolt://localhost:7687",
             "username": "neo4j",
@@ -20,6 +484,86 @@ class Neo4jClient:
         self.client = Neo4jGraph(**params)
         logger.info("Neo4j connected.")
 
+        self.db_name = db_name
+        self.ensure_schema()
+        self.snapshot: Optional[GraphSnapshot] = None
+        if snapshot:
+            self.snapshot = self._load_snapshot()
+        self._topology: Optional[GraphSnapshot] = self.snapshot
+        self._topology_lock = threading.Lock()
+
+        self.writer = GraphWriteBuffer(self.client,
+                                       policy=write_policy,
+                                       max_pending=max_pending_writes,
+                                       flush_interval=flush_interval)
+
+    def ensure_schema(self) -> None:
+        """
+        make every lookup by filename an index seek: a uniqueness constraint on Point(filename),
+        or a plain index when the constraint cannot be created (e.g. duplicated filenames). Idempotent.
+        """
+        try:
+            self.client.query(
+                "CREATE CONSTRAINT point_filename_unique IF NOT EXISTS FOR (n:Point) REQUIRE n.filename IS UNIQUE"
+            )
+        except Exception as e:
+            logger.warning(f"Failed to create a uniqueness constraint on Point(filename), falling back to an index: {e}")
+            try:
+                self.client.query("CREATE INDEX point_filename IF NOT EXISTS FOR (n:Point) ON (n.filename)")
+            except Exception as e:
+                logger.warning(f"Failed to create an index on Point(filename), lookups by filename will scan: {e}")
+
+    def write_batch(self, pending: Dict[str, List[dict]]) -> None:
+        """
+        write rows of the buffered query kinds right away, one `UNWIND` query per kind.
+        """
+        self.flush()
+        self.writer._write(pending)
+
+    def _load_snapshot(self) -> GraphSnapshot:
+        logger.info(f"Loading graph snapshot of database {self.db_name}...")
+        snapshot = GraphSnapshot.from_graph(self.client)
+        logger.info(f"Graph snapshot loaded with {len(snapshot)} nodes and {snapshot.num_edges} edges.")
+
+        return snapshot
+
+    @property
+    def topology(self) -> GraphSnapshot:
+        """
+        in-memory graph used for shortest paths and episode memory, loaded on first use when reads are not served
+        from a snapshot. Per-step reads only use it once loaded, so runs without either stay on cypher.
+        nodes and edges are never added during a simulation, so it does not go stale.
+        """
+        if self._topology is None:
+            with self._topology_lock:
+                if self._topology is None:
+                    self._topology = self._load_snapshot()
+        return self._topology
+
+    def precompute_distances(self, target_filenames: List[str]) -> None:
+        """
+        run the breadth-first search of every target up front, so that per-step lookups are O(1).
+        """
+        targets = set(target_filenames)
+        for filename in targets:
+            self.topology.distances_to(filename)
+        logger.info(f"Hop distances to {len(targets)} targets precomputed.")
+
+    def end_step(self):
+        self.writer.mark("step")
+
+    def end_round(self):
+        self.writer.mark("round")
+
+    def flush(self):
+        """
+        block until every buffered write has reached the database.
+        """
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
     @classmethod
     def _format_node(cls, node):
         ordered_node = {key: node[key] for key in
@@ -74,15 +618,17 @@ class Neo4jClient:
         查询 `filename` 对应的 `Point`，获取 `n` 跳以内的所有 `CONNECTED_TO` 关系。
         返回 {"relationships": [...], "nodes": [...]}
         """
+        self.flush()
+        # the bound of a variable-length pattern cannot be a parameter, it is one cached plan per distance.
         query = f"""
-        MATCH path = (start:Point {{filename: '{filename}'}})-[r:CONNECTED_TO*1..{topology_distance}]-(other)
+        MATCH path = (start:Point {{filename: $filename}})-[r:CONNECTED_TO*1..{int(topology_distance)}]-(other:Point)
         RETURN 
             [rel IN relationships(path) | properties(rel)] AS relationship_properties,
-            apoc.map.removeKeys(properties(start), ['gtype', 'bbox', 'month', 'year']) AS source_node,
-            apoc.map.removeKeys(properties(other), ['gtype', 'bbox', 'month', 'year']) AS target_node
+            apoc.map.removeKeys(properties(start), $hidden_keys) AS source_node,
+            apoc.map.removeKeys(properties(other), $hidden_keys) AS target_node
         """
 
-        result = self.client.query(query)
+        result = self.client.query(query, params={"filename": filename, "hidden_keys": self._HIDDEN_KEYS})
 
         # 打印原始查询结果
         if result:
@@ -99,18 +645,21 @@ class Neo4jClient:
         查询 `filename` 对应的 `Point`，在 `spatial_distance` 范围内的所有 `CONNECTED_TO` 关系。
         返回 {"relationships": [...], "nodes": [...]}
         """
-        query = f"""
-        MATCH (start:Point {{filename: '{filename}'}})
-        CALL spatial.withinDistance("locations", start, {spatial_distance / 1000}) 
+        self.flush()
+        query = """
+        MATCH (start:Point {filename: $filename})
+        CALL spatial.withinDistance("locations", start, $distance_km) 
         YIELD node AS nearby_node
-        MATCH (nearby_node)-[r:CONNECTED_TO]->(other_nearby)
+        MATCH (nearby_node:Point)-[r:CONNECTED_TO]->(other_nearby:Point)
         RETURN 
             properties(r) AS relationship_properties,
-            apoc.map.removeKeys(properties(nearby_node), ['gtype', 'bbox', 'month', 'year']) AS source_node,
-            apoc.map.removeKeys(properties(other_nearby), ['gtype', 'bbox', 'month', 'year']) AS target_node
+            apoc.map.removeKeys(properties(nearby_node), $hidden_keys) AS source_node,
+            apoc.map.removeKeys(properties(other_nearby), $hidden_keys) AS target_node
         """
 
-        result = self.client.query(query)
+        result = self.client.query(query, params={
+            "filename": filename, "distance_km": spatial_distance / 1000, "hidden_keys": self._HIDDEN_KEYS
+        })
 
         # 打印原始查询结果
         if result:
@@ -122,54 +671,32 @@ class Neo4jClient:
         return self._parse_node(result)
 
     def update_node_attribution(self, update_viewpoint: ViewPointAttrToUpdate):
-        query = """
-        MATCH (n:Point {filename: $filename})
-        SET n += $new_properties
-        RETURN n
-        """
-
-        self.client.query(
-            query,
-            params={
-                "filename": update_viewpoint.filename,
-                "new_properties": update_viewpoint.to_dict(encode_json=True)
-            }
-        )
+        self.writer.submit("node_attribution", {
+            "filename": update_viewpoint.filename,
+            "properties": update_viewpoint.to_dict(encode_json=True)
+        })
         logger.info(f"Node {update_viewpoint.filename} attributions updated.")
 
     def set_node_visited_once(self, filename):
-        query = """
-        MATCH (n: Point {filename: $filename})
-        SET n.total_visits = coalesce(n.total_visits, 0) + 1
-        RETURN n.total_visits
-        """
-
-        self.client.query(
-            query,
-            params={
-                "filename": filename
-            }
-        )
+        self.writer.submit("node_visited_once", {"filename": filename})
 
     def reset_node_attribution(self, round: int):
+        self.flush()
         query = """
-        MATCH (n: Point)
-        SET n.total_visits = 0,
-        """ + ",".join(
-            [f'n.round_{i} = "{{}}"' for i in range(1, round + 1)]
-        ) + ' RETURN n;'
+        MATCH (n:Point)
+        SET n.total_visits = 0, n += $rounds
+        """
 
-        self.client.query(query)
+        self.client.query(query, params={"rounds": {f"round_{i}": "{}" for i in range(1, round + 1)}})
 
     def reset_edge_attribution(self, round: int):
+        self.flush()
         query = """
-        MATCH (r: CONNECTED_TO)
-        SET
-        """ + ",".join(
-            [f'r.round_{i} = ""' for i in range(1, round + 1)]
-        ) + ' RETURN r;'
+        MATCH (:Point)-[r:CONNECTED_TO]->(:Point)
+        SET r += $rounds
+        """
 
-        self.client.query(query)
+        self.client.query(query, params={"rounds": {f"round_{i}": "" for i in range(1, round + 1)}})
 
 
 
@@ -204,25 +731,24 @@ class Neo4jClient:
                                   next_action: int,
                                   next_action_direction: str,
                                   next_score: float):
-        query = f"""
-        MATCH (n: Point {{filename: "{filename}"}})
-        SET n.%s = "{{
-        thought = {thought},
-        round = {current_round},
-        last_step_filename = {last_step_filename},
-        last_action = {last_action},
-        last_action_direction = {last_action_direction},
-        last_score = {last_score},
-        next_step_filename = {next_step_filename},
-        next_action = {next_action},
-        next_action_direction = {next_action_direction},
-        next_score = {next_score},
-        round_success = unknown,
-        }}"
-        """ % f"round_{current_round}"
-        self.client.query(
-            query
-        )
+        fields = {
+            "thought": thought,
+            "round": current_round,
+            "last_step_filename": last_step_filename,
+            "last_action": last_action,
+            "last_action_direction": last_action_direction,
+            "last_score": last_score,
+            "next_step_filename": next_step_filename,
+            "next_action": next_action,
+            "next_action_direction": next_action_direction,
+            "next_score": next_score,
+            "round_success": "unknown",
+        }
+        record = "{\n" + "".join(f"        {key} = {value},\n" for key, value in fields.items()) + "        }"
+        self.writer.submit("node_in_current_round", {
+            "filename": filename,
+            "properties": {f"round_{current_round}": record}
+        })
 
     def set_edge_in_current_round(self,
                                   round: int,
@@ -231,41 +757,38 @@ class Neo4jClient:
                                   action_direction: str,
                                   source_filename: str,
                                   target_filename: str):
-        query = f"""
-        MATCH (a:Point {{filename: $source_filename}})-[r:CONNECTED_TO]->(b:Point {{filename: $target_filename}})
-        SET r.round_{round} = $step,  r.action = $action, r.action_direction = $action_direction
-        RETURN r;
-        """
-        self.client.query(
-            query,
-            params={
-                "source_filename": source_filename,
-                "target_filename": target_filename,
-                "step": f"step{step}",
+        self.writer.submit("edge_in_current_round", {
+            "source_filename": source_filename,
+            "target_filename": target_filename,
+            "properties": {
+                f"round_{round}": f"step{step}",
                 "action": action,
                 "action_direction": action_direction,
             }
-        )
+        })
 
     def set_node_round_success(self, round: int, flag: bool = True):
-        query = f"""
-        MATCH (n)
-        WHERE n.round_{round} IS NOT NULL
-        SET n.round_{round} = apoc.text.replace(n.round_{round}, 'round_success = unknown', 'round_success = {flag}')
+        self.flush()
+        # property keys cannot be parameters, the round property is written through a map instead.
+        query = """
+        MATCH (n:Point)
+        WHERE n[$key] IS NOT NULL
+        SET n += apoc.map.fromValues([$key, apoc.text.replace(n[$key], 'round_success = unknown', $replacement)])
         """
         self.client.query(
-            query
+            query,
+            params={"key": f"round_{round}", "replacement": f"round_success = {flag}"}
         )
 
 
     def reset_all_viewpoint_after_epoch(self):
+        self.flush()
         status: dict = ViewPointAttrToUpdate().to_dict(encode_json=True)
         status.pop("filename")
 
         query = """
         MATCH (n:Point)
         SET n += $default_properties
-        RETURN n
         """
         self.client.query(
             query,
@@ -274,6 +797,9 @@ class Neo4jClient:
 
     def retrieve_viewpoint_from_filename(self,
                                          filename: str) -> ViewPoint:
+        if self.snapshot is not None:
+            return self.snapshot.retrieve_viewpoint_from_filename(filename)
+
         query = """
         MATCH (n:Point {filename: $filename})
         RETURN n
@@ -291,6 +817,9 @@ class Neo4jClient:
 
     def retrieve_viewpoint_from_element_id(self,
                                            element_id: str) -> ViewPointPosition:
+        if self.snapshot is not None:
+            return self.snapshot.retrieve_viewpoint_from_element_id(element_id)
+
         query = """
         MATCH (n: Point)
         WHERE elementID(n) = $elementID
@@ -307,8 +836,11 @@ class Neo4jClient:
 
     def retrieve_edges_start_from_viewpoint(self,
                                             filename: str) -> List:
+        if self.snapshot is not None:
+            return self.snapshot.retrieve_edges_start_from_viewpoint(filename)
+
         query = """
-        MATCH (n:Point {filename: $filename})-[r:CONNECTED_TO]->(m)
+        MATCH (n:Point {filename: $filename})-[r:CONNECTED_TO]->(m:Point)
         RETURN elementID(n) AS startNodeId, elementID(m) AS endNodeId, properties(r) AS rProperties
         """
 
@@ -319,21 +851,38 @@ class Neo4jClient:
     def get_closest_viewpoint(self,
                               current_viewpoint: ViewPoint,
                               azimuth: float) -> (ViewPointPosition, float):
+        # edges never change during a simulation, so they are read from the topology once it is loaded.
+        if self._topology is not None:
+            return self._topology.get_closest_viewpoint(current_viewpoint.filename, azimuth)
+
         edges = self.retrieve_edges_start_from_viewpoint(current_viewpoint.filename)
         closest = min(edges, key=lambda x: abs(x['rProperties']['azimuth'] - azimuth))
 
-        node_id = closest["endNodeId"]
+        return self.retrieve_viewpoint_from_element_id(closest["endNodeId"]), closest["rProperties"]["distance"]
+
+    def get_step_forward_azimuth(self,
+                                 last_position: ViewPointPosition,
+                                 curr_position: ViewPointPosition) -> float:
+        """
+        azimuth of a step, looked up in the edge table of a loaded topology when both positions are adjacent
+        (e.g. not after a backtrack).
+        """
+        azimuth, topology = None, self._topology
+        if topology is not None and last_position.filename in topology.index and curr_position.filename in topology.index:
+            azimuth = topology.forward_azimuth(last_position.filename, curr_position.filename)
 
-        return self.retrieve_viewpoint_from_element_id(node_id), closest["rProperties"]["distance"]
+        return Compass.get_step_forward_azimuth(last_position, curr_position) if azimuth is None else azimuth
 
     def set_history_visited(self):
-        query = f"""
+        self.flush()
+        query = """
         MATCH (n:Point)
-        WHERE n.visited is NOT NULL AND n.visited = "{VisitStatus.CURRENT_VISITED.value}"
-        SET n.visited = "{VisitStatus.HISTORY_VISITED.value}"
-        RETURN n
+        WHERE n.visited = $current
+        SET n.visited = $history
         """
-        self.client.query(query)
+        self.client.query(query, params={
+            "current": VisitStatus.CURRENT_VISITED.value, "history": VisitStatus.HISTORY_VISITED.value
+        })
         logger.info("All position visited in current epoch has been set to HISTORY_VISITED")
 
     def get_steps_between_two_viewpoints(self,
@@ -342,35 +891,17 @@ class Neo4jClient:
         
         if start_viewpoint.filename == end_viewpoint.filename:
             return 0
-        else:
-            query = """
-            MATCH (a {filename: $start_filename}), (b {filename: $end_filename})
-            MATCH p = shortestPath((a)-[:CONNECTED_TO*]-(b))
-            RETURN length(p) AS steps
-            """
 
-            steps = self.client.query(query, params={"start_filename": start_viewpoint.filename,
-                                                    "end_filename": end_viewpoint.filename})
-            return steps[0]["steps"]
+        return self.topology.steps_between(start_viewpoint.filename, end_viewpoint.filename)
 
     def get_proper_perspective_after_backtrack(self,
                                                back_viewpoint: ViewPointPosition,
                                                gt_viewpoint: ViewPointPosition,
                                                current_walkable_headings: list) -> int:
-        query = """
-        MATCH (a {filename: $start_filename}), (b {filename: $end_filename})
-        MATCH p = shortestPath((a)-[:CONNECTED_TO*]-(b))
-        RETURN p
-        """
-
-        traj = self.client.query(query, params={"start_filename": back_viewpoint.filename,
-                                                "end_filename": gt_viewpoint.filename})
-        gt_next_viewpoint = traj[0]["p"][2]
-        forward_azimuth = Compass.get_step_forward_azimuth(
-            last_position=back_viewpoint,
-            curr_position=ViewPointPosition(filename=gt_next_viewpoint["filename"],
-                                            longitude=gt_next_viewpoint["longitude"], latitude=gt_next_viewpoint["latitude"]),
+        gt_next_position = self.topology.position(
+            self.topology.next_hop(back_viewpoint.filename, gt_viewpoint.filename)
         )
+        forward_azimuth = self.get_step_forward_azimuth(back_viewpoint, gt_next_position)
         idx = find_closest_value(target=forward_azimuth, lst=current_walkable_headings)
 
         return idx
@@ -397,6 +928,7 @@ class Neo4jClient:
 
 
     def get_serval_nodes(self, trajectories: List[ViewPointPositionWithObservation]) -> List[dict]:
+        self.flush()
         query = """
         MATCH (n:Point)
         WHERE n.filename IN $filenames
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import os
+import json
+import numpy as np
+
+from pathlib import Path
+from numpy import ndarray
+from typing import List, Iterator, Union, Optional, Callable, Iterable
+
+from utils.items import GroundTruthTrajectories, ViewPointPosition
+from utils.map_logger import logger
+
+
+class GroundTruthColumns:
+    """
+    Columnar form of a ground truth QA file. Every route point is a row of flat arrays
+    (filename id, longitude, latitude) and `route_indptr` delimits the route of each question.
+    `GroundTruthTrajectories.SingleTrajectory` objects are only built for the question being simulated.
+
+    A binary copy is cached as `<gt>.npz` next to the json file and reused while the json is unchanged.
+    """
+
+    _VERSION = 2
+    _COLUMNS = ("questions", "question_idx", "idx", "services", "folders", "categories", "cities", "from_ids", "to_ids",
+                "total_weights", "total_steps", "route_indptr", "route_ids", "route_lons", "route_lats", "filenames")
+
+    def __init__(self,
+                 questions: ndarray,
+                 question_idx: ndarray,
+                 idx: ndarray,
+                 services: ndarray,
+                 folders: ndarray,
+                 categories: ndarray,
+                 cities: ndarray,
+                 from_ids: ndarray,
+                 to_ids: ndarray,
+                 total_weights: ndarray,
+                 total_steps: ndarray,
+                 route_indptr: ndarray,
+                 route_ids: ndarray,
+                 route_lons: ndarray,
+                 route_lats: ndarray,
+                 filenames: ndarray):
+        self.questions = questions
+        self.question_idx = question_idx
+        self.idx = idx
+        self.services = services
+        self.folders = folders
+        self.categories = categories
+        self.cities = cities
+        self.from_ids = from_ids
+        self.to_ids = to_ids
+        self.total_weights = total_weights
+        self.total_steps = total_steps
+        self.route_indptr = route_indptr
+        self.route_ids = route_ids
+        self.route_lons = route_lons
+        self.route_lats = route_lats
+        self.filenames = filenames
+
+    @classmethod
+    def from_records(cls, records: List[dict]) -> GroundTruthColumns:
+        vocabulary = {}
+
+        def encode(filename: str) -> int:
+            return vocabulary.setdefault(filename, len(vocabulary))
+
+        routes = [record["complete_route"] for record in records]
+
+        return cls(
+            questions=np.array([record["question"] for record in records], dtype=str),
+            question_idx=np.array([record["question_idx"] for record in records], dtype=np.int64),
+            idx=np.array([record["idx"] for record in records], dtype=np.int64),
+            # missing values are stored as empty strings.
+            services=np.array([record.get("service") or "" for record in records], dtype=str),
+            folders=np.array([record.get("folder") or "" for record in records], dtype=str),
+            categories=np.array([record.get("category") or "" for record in records], dtype=str),
+            cities=np.array([record.get("city") or "" for record in records], dtype=str),
+            from_ids=np.array([encode(record["from"]) for record in records], dtype=np.int32),
+            to_ids=np.array([encode(record["to"]) for record in records], dtype=np.int32),
+            total_weights=np.array([np.nan if record.get("total_weight") is None else record["total_weight"]
+                                    for record in records], dtype=np.float64),
+            total_steps=np.array([-1 if record.get("total_steps") is None else record["total_steps"]
+                                  for record in records], dtype=np.int64),
+            route_indptr=np.concatenate([[0], np.cumsum([len(route) for route in routes])]).astype(np.int64),
+            route_ids=np.array([encode(point["filename"]) for route in routes for point in route], dtype=np.int32),
+            route_lons=np.array([point["longitude"] for route in routes for point in route], dtype=np.float64),
+            route_lats=np.array([point["latitude"] for route in routes for point in route], dtype=np.float64),
+            filenames=np.array(list(vocabulary), dtype=str),
+        )
+
+    @classmethod
+    def from_json(cls, json_file: Union[str, Path], cache: bool = True) -> GroundTruthColumns:
+        logger.info(f"Initializing start point from file: {Path(json_file).name}.")
+        stat = os.stat(json_file)
+        source = np.array([cls._VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        cache_file = Path(json_file).with_suffix(".npz")
+
+        if cache and cache_file.exists():
+            with np.load(cache_file, allow_pickle=False) as arrays:
+                if np.array_equal(arrays["source"], source):
+                    columns = cls(**{name: arrays[name] for name in cls._COLUMNS})
+                    logger.info(f"Initialized with {len(columns)} trajectories from cache {cache_file.name}.")
+                    return columns
+
+        with open(json_file, mode="r", encoding="utf-8") as f:
+            columns = cls.from_records(json.load(f))
+        if cache:
+            try:
+                columns.save(cache_file, source)
+            except OSError as e:
+                logger.warning(f"Failed to cache {Path(json_file).name} into {cache_file}: {e}")
+        logger.info(f"Initialized with {len(columns)} trajectories.")
+
+        return columns
+
+    def save(self, cache_file: Path, source: ndarray) -> None:
+        tmp = cache_file.with_suffix(".tmp.npz")
+        np.savez(tmp, source=source, **{name: getattr(self, name) for name in self._COLUMNS})
+        os.replace(tmp, cache_file)
+
+    def __len__(self) -> int:
+        return len(self.question_idx)
+
+    def __getitem__(self, i: int) -> GroundTruthTrajectories.SingleTrajectory:
+        start, end = self.route_indptr[i], self.route_indptr[i + 1]
+
+        return GroundTruthTrajectories.SingleTrajectory(
+            question=self.questions[i].item(),
+            question_idx=self.question_idx[i].item(),
+            idx=self.idx[i].item(),
+            _from=self.filenames[self.from_ids[i]].item(),
+            to=self.filenames[self.to_ids[i]].item(),
+            service=self.services[i].item() or None,
+            total_weight=None if np.isnan(self.total_weights[i]) else self.total_weights[i].item(),
+            total_steps=None if self.total_steps[i] < 0 else self.total_steps[i].item(),
+            complete_route=[
+                ViewPointPosition(filename=filename, longitude=longitude, latitude=latitude)
+                for filename, longitude, latitude in zip(self.filenames[self.route_ids[start:end]].tolist(),
+                                                         self.route_lons[start:end].tolist(),
+                                                         self.route_lats[start:end].tolist())
+            ]
+        )
+
+    def __iter__(self) -> Iterator[GroundTruthTrajectories.SingleTrajectory]:
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def targets(self) -> List[str]:
+        """
+        filename of the last route point of every question.
+        """
+        return self.filenames[self.route_ids[self.route_indptr[1:] - 1]].tolist()
+
+
+class QuestionSource:
+    """
+    Ordered selection of the questions of a `GroundTruthColumns`, narrowed down by chaining
+    `where`, `filter`, slicing, `sample` and `shard`. Only question ordinals are kept, the episode views
+    are built one at a time while iterating.
+
+        QuestionSource.from_json(gt).where(category="question1").sample(100, seed=0)
+    """
+
+    # selectable columns, `service` also matches the question folder since most QA files leave it empty.
+    _WHERE = {
+        "question_idx": ("question_idx",),
+        "idx": ("idx",),
+        "service": ("services", "folders"),
+        "category": ("categories",),
+        "city": ("cities",),
+    }
+
+    def __init__(self, columns: GroundTruthColumns, indices: Optional[ndarray] = None):
+        self.columns = columns
+        self.indices = np.arange(len(columns), dtype=np.int64) if indices is None else indices
+
+    @classmethod
+    def from_json(cls, json_file: Union[str, Path], cache: bool = True) -> QuestionSource:
+        return cls(GroundTruthColumns.from_json(json_file, cache=cache))
+
+    def _select(self, indices: ndarray) -> QuestionSource:
+        return QuestionSource(self.columns, indices)
+
+    def where(self, **conditions: Union[int, str, range, Iterable]) -> QuestionSource:
+        """
+        keep the questions whose columns match every condition, a value or a collection of accepted values.
+        """
+        mask = np.ones(len(self.indices), dtype=bool)
+        for key, accepted in conditions.items():
+            if key not in self._WHERE:
+                raise ValueError(f"Unknown question column {key}, should be one of {', '.join(self._WHERE)}.")
+            values = [getattr(self.columns, name)[self.indices] for name in self._WHERE[key]]
+            if isinstance(accepted, range) and accepted.step == 1:
+                mask &= np.logical_or.reduce([(value >= accepted.start) & (value < accepted.stop) for value in values])
+                continue
+            if isinstance(accepted, (str, int)):
+                accepted = [accepted]
+            mask &= np.logical_or.reduce([np.isin(value, list(accepted)) for value in values])
+
+        return self._select(self.indices[mask])
+
+    def filter(self, predicate: Callable[[GroundTruthTrajectories.SingleTrajectory], bool]) -> QuestionSource:
+        """
+        keep the questions whose episode view satisfies the predicate, views are dropped right after the test.
+        """
+        return self._select(np.array([i for i in self.indices.tolist() if predicate(self.columns[i])], dtype=np.int64))
+
+    def filter_keys(self, predicate: Callable[[int, int], bool]) -> QuestionSource:
+        """
+        keep the questions whose (question_idx, idx) satisfy the predicate, without building any view.
+        """
+        return self._select(np.array([
+            i for i, (question_idx, idx) in zip(self.indices.tolist(), self.keys) if predicate(question_idx, idx)
+        ], dtype=np.int64))
+
+    def sample(self, n: int, seed: int = 0) -> QuestionSource:
+        """
+        seeded sample of n questions, kept in file order.
+        """
+        rng = np.random.default_rng(seed)
+        chosen = rng.choice(len(self.indices), size=min(n, len(self.indices)), replace=False)
+
+        return self._select(self.indices[np.sort(chosen)])
+
+    def shard(self, index: int, count: int) -> QuestionSource:
+        return self._select(self.indices[index::count])
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[GroundTruthTrajectories.SingleTrajectory, QuestionSource]:
+        if isinstance(item, slice):
+            return self._select(self.indices[item])
+
+        return self.columns[int(self.indices[item])]
+
+    def __iter__(self) -> Iterator[GroundTruthTrajectories.SingleTrajectory]:
+        for i in self.indices.tolist():
+            yield self.columns[i]
+
+    @property
+    def keys(self) -> List[tuple]:
+        """
+        (question_idx, idx) of every selected question.
+        """
+        return list(zip(self.columns.question_idx[self.indices].tolist(), self.columns.idx[self.indices].tolist()))
+
+    @property
+    def targets(self) -> List[str]:
+        return self.columns.filenames[self.columns.route_ids[self.columns.route_indptr[self.indices + 1] - 1]].tolist()
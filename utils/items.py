@@ -1,6 +1,6 @@
 from enum import Enum
 from numpy import ndarray
-from typing import List, Union, Dict
+from typing import List, Union, Dict, Callable, Optional
 from pydantic import BaseModel, Field
 from dataclasses import dataclass, field
 from dataclasses_json import dataclass_json, config
@@ -118,7 +118,17 @@ class ViewPointPosition:
 @dataclass
 class PanoItem:
     perspective: ndarray
-    mask: ndarray
+    mask_factory: Optional[Callable[[], ndarray]] = field(default=None, repr=False)
+    _mask: Optional[ndarray] = field(default=None, repr=False)
+
+    @property
+    def mask(self) -> ndarray:
+        """
+        pano with the outline of the perspective, only drawn when it is asked for.
+        """
+        if self._mask is None and self.mask_factory is not None:
+            self._mask = self.mask_factory()
+        return self._mask
 
 
 @dataclass
@@ -2,14 +2,26 @@ from __future__ import annotations
 
 import json
 import os
+import threading
 
 from tqdm import tqdm
 from queue import Queue
 from pathlib import Path
 from datetime import datetime
-from typing import Union, Literal
+from typing import Union, Literal, Optional, Set, Tuple
 from loguru._logger import Logger, Core
 from utils.items import ViewPointPosition, SimulationTrajectories, ViewPointPositionWithObservation
+from utils.operation import convert_trajectories, read_trajectories
+
+
+class TrajectoryBuffer:
+    """
+    positions and step distances collected by one running episode.
+    """
+
+    def __init__(self):
+        self.trajectory: Queue[ViewPointPositionWithObservation] = Queue()
+        self.distance_container = []
 
 
 class MapLogger(Logger):
@@ -45,8 +57,22 @@ class MapLogger(Logger):
         self.trajectory: Queue[ViewPointPositionWithObservation] = Queue()
         self.json_file = json_file if isinstance(json_file, str) else json_file.as_posix()
         self.distance_container = []
-        with open(self.json_file, mode="w", encoding="utf-8") as f:
-            json.dump([], f, indent=4, ensure_ascii=False)
+
+        # trajectories are appended as json lines, one per round, and fsync-ed every `fsync_every` lines.
+        self.fsync_every = int(os.getenv("TRAJECTORY_FSYNC_EVERY", 16))
+        self._unsynced = 0
+        self._sink_lock = threading.Lock()
+        # both files are opened on the first save or checkpoint lookup, importing the logger creates neither.
+        self._sink = None
+        self._manifest = None
+
+        # (question_idx, idx, round_num) of every saved round, used to resume an interrupted run.
+        self.manifest_file = Path(self.json_file).with_suffix(".manifest.jsonl").as_posix()
+        self.completed: Set[Tuple[int, int, int]] = set()
+
+        # episode memory of each finished round, restored when a question is resumed part-way.
+        self.memory_file = Path(self.json_file).with_suffix(".memory.jsonl").as_posix()
+        self._memory_sink = None
 
     @classmethod
     def from_json(cls,
@@ -66,9 +92,11 @@ class MapLogger(Logger):
 
     def insert_step(self,
                     viewpoint: ViewPointPositionWithObservation,
-                    distance: float) -> None:
-        self.trajectory.put(viewpoint)
-        self.distance_container.append(distance)
+                    distance: float,
+                    buffer: Optional[TrajectoryBuffer] = None) -> None:
+        buffer = self if buffer is None else buffer
+        buffer.trajectory.put(viewpoint)
+        buffer.distance_container.append(distance)
 
         self.info(f"""
         
@@ -76,6 +104,166 @@ class MapLogger(Logger):
                     Step Distance: {distance}m
                     """)
 
+    def build_single_trajectory(self,
+                                question: str,
+                                question_idx: int,
+                                idx: int,
+                                _from: str,
+                                to: str,
+                                service: str,
+                                total_weight: float,
+                                total_steps: int,
+                                flag: bool = False,
+                                cost: float = 0.0,
+                                round_num: int = 0,
+                                round_success: bool = False,
+                                buffer: Optional[TrajectoryBuffer] = None) -> SimulationTrajectories.Trajectory:
+        buffer = self if buffer is None else buffer
+        trajectory = SimulationTrajectories.Trajectory(
+            question, question_idx, idx, _from, to, service, total_weight, total_steps,
+            list(buffer.trajectory.queue), flag, cost, round_num, round_success
+        )
+
+        # clear all positions.
+        with buffer.trajectory.mutex:
+            buffer.trajectory.queue.clear()
+            buffer.distance_container.clear()
+
+        return trajectory
+
+    @classmethod
+    def _open_sink(cls, json_file: str):
+        """
+        open the jsonl file for appending, dropping the incomplete last line of an interrupted run.
+        """
+        Path(json_file).parent.mkdir(exist_ok=True, parents=True)
+        sink = open(json_file, mode="a+b")
+        size = sink.seek(0, os.SEEK_END)
+        if size:
+            sink.seek(max(size - (1 << 20), 0))
+            tail = sink.read()
+            if not tail.endswith(b"\n"):
+                end = tail.rfind(b"\n")
+                sink.truncate(size - len(tail) + end + 1 if end >= 0 else 0)
+
+        return sink
+
+    def _ensure_open(self) -> None:
+        if self._manifest is not None:
+            return
+        with self._sink_lock:
+            if self._manifest is None:
+                self._sink = self._open_sink(self.json_file)
+                self._manifest = self._open_manifest()
+
+    def _open_manifest(self):
+        """
+        load the checkpoint manifest, adding the rounds found in the trajectory file but missing from it.
+        """
+        manifest = self._open_sink(self.manifest_file)
+        manifest.seek(0)
+        for line in manifest:
+            entry = json.loads(line)
+            self.completed.add((entry["question_idx"], entry["idx"], entry["round_num"]))
+
+        if os.path.getsize(self.json_file):
+            for trajectory in read_trajectories(self.json_file):
+                key = (trajectory["question_idx"], trajectory["idx"], trajectory["round"])
+                if key not in self.completed:
+                    manifest.write(self._manifest_line(*key))
+                    self.completed.add(key)
+            manifest.flush()
+
+        if self.completed:
+            self.info(f"Resuming from {self.manifest_file} with {len(self.completed)} rounds already finished.")
+
+        return manifest
+
+    @classmethod
+    def _manifest_line(cls, question_idx: int, idx: int, round_num: int) -> bytes:
+        return (json.dumps({"question_idx": question_idx, "idx": idx, "round_num": round_num}) + "\n").encode("utf-8")
+
+    def is_completed(self, question_idx: int, idx: int, round_num: int) -> bool:
+        self._ensure_open()
+        return (question_idx, idx, round_num) in self.completed
+
+    def save_trajectory(self, trajectory: SimulationTrajectories.Trajectory) -> None:
+        line = json.dumps(trajectory.to_dict(encode_json=True), ensure_ascii=False) + "\n"
+        key = (trajectory.question_idx, trajectory.idx, trajectory.round)
+        self._ensure_open()
+        with self._sink_lock:
+            self._sink.write(line.encode("utf-8"))
+            self._sink.flush()
+            # the round is checkpointed only once its trajectory has been written.
+            self._manifest.write(self._manifest_line(*key))
+            self._manifest.flush()
+            self.completed.add(key)
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                self._sync()
+
+        self.success(f"Trajectory {trajectory.idx} saved.")
+
+    def save_memory(self, question_idx: int, idx: int, round_num: int, state: dict) -> None:
+        """
+        append the episode memory of a round, before its trajectory is saved, so every checkpointed round has one.
+        """
+        line = json.dumps({"question_idx": question_idx, "idx": idx, "round_num": round_num, "state": state},
+                          ensure_ascii=False) + "\n"
+        with self._sink_lock:
+            if self._memory_sink is None:
+                self._memory_sink = self._open_sink(self.memory_file)
+            self._memory_sink.write(line.encode("utf-8"))
+            self._memory_sink.flush()
+
+    def load_memory(self, question_idx: int, idx: int, round_num: int) -> Optional[dict]:
+        """
+        episode memory saved at the end of a round, None if it was not saved (e.g. a run with graph memory).
+        """
+        with self._sink_lock:
+            if self._memory_sink is not None:
+                self._memory_sink.flush()
+        if not os.path.exists(self.memory_file):
+            return None
+
+        state = None
+        with open(self.memory_file, mode="rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                entry = json.loads(line)
+                if (entry["question_idx"], entry["idx"], entry["round_num"]) == (question_idx, idx, round_num):
+                    state = entry["state"]
+
+        return state
+
+    def _sync(self) -> None:
+        if self._memory_sink is not None:
+            os.fsync(self._memory_sink.fileno())
+        os.fsync(self._sink.fileno())
+        os.fsync(self._manifest.fileno())
+        self._unsynced = 0
+
+    def close_sink(self) -> None:
+        if self._manifest is None:
+            return
+        with self._sink_lock:
+            self._sink.flush()
+            self._manifest.flush()
+            self._sync()
+
+    def export_json(self) -> str:
+        """
+        write the trajectories collected so far as a json array next to the jsonl file.
+        """
+        self._ensure_open()
+        self.close_sink()
+        json_file = Path(self.json_file).with_suffix(".json").as_posix()
+        convert_trajectories(self.json_file, json_file)
+        self.success(f"Trajectories exported to {json_file}.")
+
+        return json_file
+
     def make_single_trajectory(self,
                                question: str,
                                question_idx: int,
@@ -88,26 +276,12 @@ class MapLogger(Logger):
                                flag: bool = False,
                                cost: float = 0.0,
                                round_num: int = 0,
-                               round_success: bool = False) -> None:
-        trajectory = SimulationTrajectories.Trajectory(
+                               round_success: bool = False,
+                               buffer: Optional[TrajectoryBuffer] = None) -> None:
+        self.save_trajectory(self.build_single_trajectory(
             question, question_idx, idx, _from, to, service, total_weight, total_steps,
-            list(self.trajectory.queue), flag, cost, round_num, round_success
-        )
-
-        # clear all positions.
-        with self.trajectory.mutex:
-            self.trajectory.queue.clear()
-            self.distance_container.clear()
-
-        with open(self.json_file, mode="r+", encoding="utf-8") as f:
-            data: list = json.load(f)
-            f.seek(0)
-            f.truncate(0)
-            data.append(trajectory.to_dict(encode_json=True))
-            json.dump(data, f, indent=4, ensure_ascii=False)
-
-        self.success(f"Trajectory {idx} saved.")
-
+            flag, cost, round_num, round_success, buffer
+        ))
 
 logger = MapLogger.from_json(
     json_file=os.environ["STORE_JSON"],
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import numpy as np
+
+from typing import Dict, List, Tuple
+
+from utils.client import GraphSnapshot, Neo4jClient
+from utils.items import ViewPointAttrToUpdate, VisitStatus, ViewPointPositionWithObservation
+from utils.operation import Compass
+
+
+class EpisodeMemory:
+    """
+    Round state of one question (node attributions, `total_visits`, `visited`, node and edge `round_N`),
+    kept in dicts keyed by filename instead of on the shared graph. It has the same methods as `Neo4jClient`
+    for these properties, and retrieval reads the static node and edge properties from the graph snapshot,
+    so questions simulated at the same time do not see each other and round sweeps only touch visited nodes.
+    """
+
+    def __init__(self, topology: GraphSnapshot):
+        self.topology = topology
+        self.nodes: Dict[str, dict] = {}
+        self.edges: Dict[Tuple[str, str], dict] = {}
+
+    def _node(self, filename: str) -> dict:
+        return self.nodes.setdefault(filename, {})
+
+    def node_properties(self, i: int) -> dict:
+        """
+        properties of node ordinal i as stored in neo4j: static properties from the snapshot, then the round state.
+        """
+        filename = self.topology.filenames[i]
+        properties = {
+            "filename": filename,
+            "longitude": self.topology.longitudes[i].item(),
+            "latitude": self.topology.latitudes[i].item(),
+            "heading": self.topology.headings[i].item(),
+            "walkable_headings": self.topology.walkable_headings[
+                self.topology.walkable_indptr[i]: self.topology.walkable_indptr[i + 1]
+            ].tolist(),
+        }
+        properties.update(self.nodes.get(filename, {}))
+
+        return properties
+
+    def edge_properties(self, e: int) -> dict:
+        source = self.topology.filenames[self.topology.sources[e]]
+        target = self.topology.filenames[self.topology.targets[e]]
+        properties = {"azimuth": self.topology.azimuths[e].item(), "distance": self.topology.distances[e].item()}
+        properties.update(self.edges.get((source, target), {}))
+
+        return properties
+
+    def update_node_attribution(self, update_viewpoint: ViewPointAttrToUpdate):
+        node = self._node(update_viewpoint.filename)
+        # like `SET n += properties`, null values remove the property.
+        for key, value in update_viewpoint.to_dict(encode_json=True).items():
+            if value is None:
+                node.pop(key, None)
+            else:
+                node[key] = value
+
+    def set_node_visited_once(self, filename):
+        node = self._node(filename)
+        node["total_visits"] = node.get("total_visits", 0) + 1
+
+    def set_node_in_current_round(self,
+                                  filename: str,
+                                  current_round: int,
+                                  thought: str,
+                                  last_step_filename: str,
+                                  last_action: int,
+                                  last_action_direction: str,
+                                  last_score: float,
+                                  next_step_filename: str,
+                                  next_action: int,
+                                  next_action_direction: str,
+                                  next_score: float):
+        fields = {
+            "thought": thought,
+            "round": current_round,
+            "last_step_filename": last_step_filename,
+            "last_action": last_action,
+            "last_action_direction": last_action_direction,
+            "last_score": last_score,
+            "next_step_filename": next_step_filename,
+            "next_action": next_action,
+            "next_action_direction": next_action_direction,
+            "next_score": next_score,
+            "round_success": "unknown",
+        }
+        record = "{\n" + "".join(f"        {key} = {value},\n" for key, value in fields.items()) + "        }"
+        self._node(filename)[f"round_{current_round}"] = record
+
+    def set_edge_in_current_round(self,
+                                  round: int,
+                                  step: int,
+                                  action: int,
+                                  action_direction: str,
+                                  source_filename: str,
+                                  target_filename: str):
+        # only existing edges are written, as the MATCH of the graph query.
+        if not self.topology.has_edge(source_filename, target_filename):
+            return
+        self.edges.setdefault((source_filename, target_filename), {}).update({
+            f"round_{round}": f"step{step}",
+            "action": action,
+            "action_direction": action_direction,
+        })
+
+    def set_node_round_success(self, round: int, flag: bool = True):
+        key = f"round_{round}"
+        for node in self.nodes.values():
+            if key in node:
+                node[key] = node[key].replace("round_success = unknown", f"round_success = {flag}")
+
+    def set_history_visited(self):
+        for node in self.nodes.values():
+            if node.get("visited") == VisitStatus.CURRENT_VISITED.value:
+                node["visited"] = VisitStatus.HISTORY_VISITED.value
+
+    def reset_node_attribution(self, round: int):
+        for node in self.nodes.values():
+            node["total_visits"] = 0
+            node.update({f"round_{i}": "{}" for i in range(1, round + 1)})
+
+    def reset_edge_attribution(self, round: int):
+        for edge in self.edges.values():
+            edge.update({f"round_{i}": "" for i in range(1, round + 1)})
+
+    def _without_hidden_keys(self, properties: dict) -> dict:
+        return {key: value for key, value in properties.items() if key not in Neo4jClient._HIDDEN_KEYS}
+
+    def query_topology_distance(self, filename: str, topology_distance: int = 1):
+        """
+        same rows as the `CONNECTED_TO*1..n` pattern of `Neo4jClient.query_topology_distance`: one row per path,
+        edges are traversed in both directions and never twice in the same path.
+        """
+        start = self.topology.index[filename]
+        source_node = self._without_hidden_keys(self.node_properties(start))
+        rows = []
+
+        def expand(node: int, path: List[int]):
+            for e, other in self.topology.incident_edges(node):
+                if e in path:
+                    continue
+                rows.append({
+                    "relationship_properties": [self.edge_properties(edge) for edge in path + [e]],
+                    "source_node": source_node,
+                    "target_node": self._without_hidden_keys(self.node_properties(other)),
+                })
+                if len(path) + 1 < topology_distance:
+                    expand(other, path + [e])
+
+        expand(start, [])
+
+        return Neo4jClient._parse_node(rows)
+
+    def query_spatial_distance(self, filename: str, spatial_distance: float = 100.0):
+        """
+        outgoing edges of every node within `spatial_distance` meters of the viewpoint,
+        as `Neo4jClient.query_spatial_distance`.
+        """
+        start = self.topology.index[filename]
+        _, distances = Compass.inverse(
+            np.full(len(self.topology), self.topology.longitudes[start]),
+            np.full(len(self.topology), self.topology.latitudes[start]),
+            self.topology.longitudes, self.topology.latitudes
+        )
+        rows = []
+        for node in np.flatnonzero(distances <= spatial_distance).tolist():
+            source_node = self._without_hidden_keys(self.node_properties(node))
+            for e in range(self.topology.indptr[node], self.topology.indptr[node + 1]):
+                rows.append({
+                    "relationship_properties": self.edge_properties(e),
+                    "source_node": source_node,
+                    "target_node": self._without_hidden_keys(self.node_properties(self.topology.targets[e])),
+                })
+
+        return Neo4jClient._parse_node(rows)
+
+    def get_serval_nodes(self, trajectories: List[ViewPointPositionWithObservation]) -> List[dict]:
+        nodes = []
+        for filename in dict.fromkeys(trajectory.filename for trajectory in trajectories):
+            node = self.node_properties(self.topology.index[filename])
+            nodes.append({
+                key: value for key, value in node.items() if not key.startswith("round") and key not in ["gtype", "bbox"]
+            })
+
+        return nodes
+
+    def state(self) -> dict:
+        """
+        round state as json values, restored by `restore`.
+        """
+        return {
+            "nodes": self.nodes,
+            "edges": [[source, target, properties] for (source, target), properties in self.edges.items()],
+        }
+
+    def restore(self, state: dict) -> None:
+        self.nodes = {filename: dict(properties) for filename, properties in state["nodes"].items()}
+        self.edges = {(source, target): dict(properties) for source, target, properties in state["edges"]}
+
+    def persist(self, client: Neo4jClient) -> None:
+        """
+        write the round state to the graph, one batched query for the nodes and one for the edges.
+        """
+        client.write_batch({
+            "node_attribution": [
+                {"filename": filename, "properties": properties} for filename, properties in self.nodes.items()
+            ],
+            "edge_in_current_round": [
+                {"source_filename": source, "target_filename": target, "properties": properties}
+                for (source, target), properties in self.edges.items()
+            ],
+        })
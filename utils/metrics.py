@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import numpy as np
+
+from numpy import ndarray
+from collections import defaultdict
+from typing import List, Dict, Optional, Tuple, TYPE_CHECKING
+
+from utils.operation import Compass
+
+if TYPE_CHECKING:
+    from utils.client import GraphSnapshot
+
+
+_EARTH_RADIUS = 6371008.8
+
+METRICS = ("TCE", "TCP", "TCC", "SPD", "nDTW")
+
+
+class TrajectoryMetrics:
+    """
+    Benchmark metrics of simulated trajectories against their ground truth, one value per trajectory:
+
+    TCE   the agent stopped exactly at the target viewpoint
+    TCP   the agent stopped within `proximity` meters (geodesic) of the target
+    TCC   every round of the question satisfies TCP, aggregated per question
+    SPD   length in meters of the shortest graph path from the final viewpoint to the target
+    nDTW  normalized dynamic time warping, exp(-DTW / (|R| * proximity)) with |R| the number of reference
+          viewpoints: 1 when the walked route follows the reference, towards 0 as it drifts away
+    """
+
+    @classmethod
+    def to_local_meters(cls, lons: ndarray, lats: ndarray, origin_lon: ndarray, origin_lat: ndarray) -> ndarray:
+        """
+        equirectangular projection around a per-row origin, accurate to centimeters at city-block scale.
+        """
+        x = np.radians(lons - origin_lon[:, None]) * np.cos(np.radians(origin_lat))[:, None] * _EARTH_RADIUS
+        y = np.radians(lats - origin_lat[:, None]) * _EARTH_RADIUS
+
+        return np.stack([x, y], axis=-1)
+
+    @classmethod
+    def _pad(cls, routes: List[List[dict]]) -> Tuple[ndarray, ndarray, ndarray]:
+        lengths = np.array([len(route) for route in routes], dtype=np.int64)
+        lons = np.zeros((len(routes), max(lengths.max(initial=0), 1)), dtype=np.float64)
+        lats = np.zeros_like(lons)
+        for i, route in enumerate(routes):
+            lons[i, :len(route)] = [position["longitude"] for position in route]
+            lats[i, :len(route)] = [position["latitude"] for position in route]
+
+        return lons, lats, lengths
+
+    @classmethod
+    def dtw(cls, predictions: ndarray, pred_lengths: ndarray, references: ndarray, ref_lengths: ndarray) -> ndarray:
+        """
+        dynamic time warping distances of a batch of padded 2d routes, NaN for empty routes.
+        The DP runs row by row over the walked route for the whole batch at once. Within a row,
+        D[j] = c[j] + min(t[j], D[j - 1]) with t[j] = min(D_prev[j], D_prev[j - 1]), which unrolls to
+        D = C + cummin(t - C) where C is the cumulative sum of the row costs.
+
+        :param predictions: (B, P, 2) walked routes, padded
+        :param references: (B, R, 2) reference routes, padded
+        """
+        batch = np.arange(len(predictions))
+        result = np.full(len(predictions), np.nan, dtype=np.float64)
+        previous = None
+        for i in range(predictions.shape[1]):
+            cost = np.linalg.norm(predictions[:, i, None, :] - references, axis=-1)
+            if previous is None:
+                best = np.full_like(cost, np.inf)
+                best[:, 0] = 0.0
+            else:
+                diagonal = np.concatenate([np.full((len(cost), 1), np.inf), previous[:, :-1]], axis=1)
+                best = np.minimum(previous, diagonal)
+            cumulative = np.cumsum(cost, axis=1)
+            previous = cumulative + np.minimum.accumulate(cost + best - cumulative, axis=1)
+
+            done = (pred_lengths == i + 1) & (ref_lengths > 0)
+            result[done] = previous[batch[done], ref_lengths[done] - 1]
+
+        return result
+
+    @classmethod
+    def evaluate(cls,
+                 trajectories: List[dict],
+                 ground_truth: List[dict],
+                 snapshot: Optional[GraphSnapshot] = None,
+                 proximity: float = 50.0) -> Dict[str, ndarray]:
+        """
+        :param trajectories: simulation outputs, as read by `read_trajectories`
+        :param ground_truth: raw ground truth questions, matched on (question_idx, idx)
+        :param snapshot: graph of the city used for SPD, left NaN when not given
+        :param proximity: radius in meters of TCP, also the success threshold of nDTW
+        :return: one column per field, one row per trajectory
+        """
+        questions = {(question["question_idx"], question["idx"]): question for question in ground_truth}
+        matched = [(trajectory, questions[(trajectory["question_idx"], trajectory["idx"])])
+                   for trajectory in trajectories if (trajectory["question_idx"], trajectory["idx"]) in questions]
+        if not matched:
+            raise ValueError("No trajectory matches the ground truth questions.")
+
+        walked = [trajectory["complete_route"] for trajectory, _ in matched]
+        routes = [question["complete_route"] for _, question in matched]
+        targets = [route[-1] for route in routes]
+        finals = [route[-1] if route else {"filename": None, "longitude": np.nan, "latitude": np.nan}
+                  for route in walked]
+
+        target_lons = np.array([target["longitude"] for target in targets], dtype=np.float64)
+        target_lats = np.array([target["latitude"] for target in targets], dtype=np.float64)
+        _, errors = Compass.inverse(
+            np.array([final["longitude"] for final in finals], dtype=np.float64),
+            np.array([final["latitude"] for final in finals], dtype=np.float64),
+            target_lons, target_lats
+        )
+
+        spd = np.full(len(matched), np.nan, dtype=np.float64)
+        if snapshot is not None:
+            for i, (final, target) in enumerate(zip(finals, targets)):
+                if final["filename"] in snapshot.index and target["filename"] in snapshot.index:
+                    spd[i] = snapshot.path_lengths_to(target["filename"])[snapshot.index[final["filename"]]]
+
+        pred_lons, pred_lats, pred_lengths = cls._pad(walked)
+        ref_lons, ref_lats, ref_lengths = cls._pad(routes)
+        distances = cls.dtw(
+            cls.to_local_meters(pred_lons, pred_lats, target_lons, target_lats), pred_lengths,
+            cls.to_local_meters(ref_lons, ref_lats, target_lons, target_lats), ref_lengths
+        )
+
+        return {
+            "question_idx": np.array([trajectory["question_idx"] for trajectory, _ in matched]),
+            "idx": np.array([trajectory["idx"] for trajectory, _ in matched]),
+            "round": np.array([trajectory.get("round", 0) for trajectory, _ in matched]),
+            "city": np.array([str(question.get("city")) for _, question in matched]),
+            "service": np.array([str(question.get("service") or question.get("folder")) for _, question in matched]),
+            "category": np.array([str(question.get("category")) for _, question in matched]),
+            "TCE": np.array([final["filename"] == target["filename"] for final, target in zip(finals, targets)]),
+            "TCP": errors <= proximity,
+            "error": errors,
+            "SPD": spd,
+            "nDTW": np.exp(-distances / (np.maximum(ref_lengths, 1) * proximity)),
+        }
+
+    @classmethod
+    def _finite_mean(cls, values: ndarray) -> float:
+        """
+        mean over the trajectories where the metric is defined, unreachable or empty routes are left out.
+        """
+        values = values[np.isfinite(values)]
+
+        return float(values.mean()) if values.size else float("nan")
+
+    @classmethod
+    def summarize(cls, columns: Dict[str, ndarray], by: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        """
+        average every metric over all trajectories, or per value of the `by` column (city, service, category).
+        TCE and TCP are averaged over trajectories, TCC over questions.
+        """
+        groups = {"all": np.ones(len(columns["TCE"]), dtype=bool)} if by is None else {
+            value: columns[by] == value for value in np.unique(columns[by])
+        }
+
+        summary = {}
+        for name, mask in groups.items():
+            consistent = defaultdict(lambda: True)
+            for question_idx, idx, tcp in zip(columns["question_idx"][mask], columns["idx"][mask],
+                                              columns["TCP"][mask]):
+                consistent[(question_idx, idx)] &= bool(tcp)
+
+            summary[name] = {
+                "trajectories": int(mask.sum()),
+                "questions": len(consistent),
+                "TCE": float(columns["TCE"][mask].mean()),
+                "TCP": float(columns["TCP"][mask].mean()),
+                "TCC": float(np.mean(list(consistent.values()))),
+                "SPD": cls._finite_mean(columns["SPD"][mask]),
+                "nDTW": cls._finite_mean(columns["nDTW"][mask]),
+            }
+
+        return summary
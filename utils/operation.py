@@ -10,7 +10,7 @@ from pyproj import Geod
 from pathlib import Path
 from numpy import ndarray
 from functools import wraps
-from typing import Dict, Union
+from typing import Dict, Union, List, Optional
 from string import ascii_uppercase
 
 from .items import ChoiceReActNode, ViewPointPosition, Direction, MultiModels
@@ -20,13 +20,22 @@ def get_store_json_path(
         gt_json: str,
         db_name: str,
         agent: MultiModels,
-        log_level: str
+        log_level: str,
+        resume: Optional[str] = None
 ) -> str:
+    """
+    :param resume: existing .jsonl output to append to, finished rounds listed in its manifest are skipped
+    """
     section = Path(gt_json).parent.name
 
-    store = Path(__file__).parent.parent / "output_dir" / db_name / section / "trajectories"
-    store.mkdir(exist_ok=True, parents=True)
-    store_json = store / f"{agent.name}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{Path(gt_json).name}"
+    if resume is not None:
+        if Path(resume).suffix != ".jsonl":
+            raise ValueError(f"only .jsonl trajectory outputs can be resumed, got {resume}.")
+        store_json = Path(resume).absolute()
+    else:
+        store = Path(__file__).parent.parent / "output_dir" / db_name / section / "trajectories"
+        store.mkdir(exist_ok=True, parents=True)
+        store_json = store / f"{agent.name}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{Path(gt_json).stem}.jsonl"
 
     os.environ["STORE_JSON"] = store_json.as_posix()
     os.environ["CITY_NAME"] = db_name
@@ -37,10 +46,18 @@ def get_store_json_path(
     return store_json.as_posix()
 
 
-def image_to_base64(image: ndarray) -> str:
-    _, buffer = cv2.imencode('.jpg', image)
+def image_to_jpeg(image: ndarray, quality: int = 95) -> bytes:
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+
+    return buffer.tobytes()
+
 
-    return f"data:image/jpeg;base64,{base64.b64encode(buffer.data).decode('utf-8')}"
+def jpeg_to_base64(buffer: bytes) -> str:
+    return f"data:image/jpeg;base64,{base64.b64encode(buffer).decode('utf-8')}"
+
+
+def image_to_base64(image: ndarray, quality: int = 95) -> str:
+    return jpeg_to_base64(image_to_jpeg(image, quality))
 
 
 def read_json(json_file: str) -> dict:
@@ -57,6 +74,38 @@ def read_json(json_file: str) -> dict:
     return data
 
 
+def read_trajectories(trajectory_file: str) -> List[dict]:
+    """
+    read simulation trajectories from either the jsonl output or a converted json array.
+    """
+    with open(trajectory_file, mode="r", encoding="utf-8") as f:
+        if Path(trajectory_file).suffix != ".jsonl":
+            return json.load(f)
+
+        trajectories = []
+        for line in f:
+            if line.strip():
+                try:
+                    trajectories.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break  # the last line of an interrupted run
+
+        return trajectories
+
+
+def convert_trajectories(jsonl_file: str, json_file: str) -> int:
+    """
+    convert the jsonl trajectories into the json array format, returns the number of trajectories.
+    """
+    trajectories = read_trajectories(jsonl_file)
+    tmp = f"{json_file}.tmp"
+    with open(tmp, mode="w", encoding="utf-8") as f:
+        json.dump(trajectories, f, indent=4, ensure_ascii=False)
+    os.replace(tmp, json_file)
+
+    return len(trajectories)
+
+
 def check_env_variables():
     required_vars = [
         "NEO4J_PASSWORD", "OPENAI_API_BASE", "OPENAI_API_KEY",
@@ -177,6 +226,32 @@ class Compass:
 
         return azimuth
 
+    @classmethod
+    def inverse(cls,
+                lons1: ndarray,
+                lats1: ndarray,
+                lons2: ndarray,
+                lats2: ndarray) -> (ndarray, ndarray):
+        """
+        forward azimuths and distances in meters from every point 1 to its point 2, in one call.
+        """
+        azimuths, back_azimuths, distances = cls._geodestic.inv(
+            np.asarray(lons1, dtype=np.float64), np.asarray(lats1, dtype=np.float64),
+            np.asarray(lons2, dtype=np.float64), np.asarray(lats2, dtype=np.float64)
+        )
+
+        return np.asarray(azimuths), np.asarray(distances)
+
+    @classmethod
+    def get_step_forward_azimuths(cls, positions: List[ViewPointPosition]) -> (ndarray, ndarray):
+        """
+        azimuths and distances of every step along a trajectory, one less than the number of positions.
+        """
+        lons = np.array([position.longitude for position in positions], dtype=np.float64)
+        lats = np.array([position.latitude for position in positions], dtype=np.float64)
+
+        return cls.inverse(lons[:-1], lats[:-1], lons[1:], lats[1:])
+
     @classmethod
     def get_relative_direction(cls,
                                forward_azimuth: float,
@@ -189,6 +264,19 @@ class Compass:
 
         return Direction.get_direction_by_index(index)
 
+    @classmethod
+    def get_relative_directions(cls,
+                                forward_azimuth: float,
+                                headings: Union[List[float], ndarray]) -> List[Direction]:
+        """
+        batch version of `get_relative_direction`, one direction per heading.
+        """
+        relative_angles = (np.asarray(headings, dtype=np.float64) % 360 - forward_azimuth % 360 + 360) % 360
+        indices = ((relative_angles + 22.5) // 45).astype(int) % 8
+        directions = list(Direction)
+
+        return [directions[index] for index in indices]
+
 
 
 
@@ -1,9 +1,13 @@
 import os
 import cv2
+import threading
 import numpy as np
 
 from pathlib import Path
 from numpy import ndarray
+from functools import lru_cache, partial
+from typing import Tuple
+from collections import OrderedDict
 from utils.items import PanoItem
 
 
@@ -34,41 +38,94 @@ def lonlat_to_xy(lonlat, shape):
     return out
 
 
+@lru_cache(maxsize=8)
+def ray_grid(fov: int, height: int, width: int) -> ndarray:
+    """
+    camera rays of every perspective pixel, only depends on the perspective parameters.
+    """
+    f = 0.5 * width * 1 / np.tan(0.5 * fov / 180.0 * np.pi)
+    cx = (width - 1) / 2.0
+    cy = (height - 1) / 2.0
+    k = np.array([
+        [f, 0, cx],
+        [0, f, cy],
+        [0, 0, 1],
+    ], np.float32)
+    k_inv = np.linalg.inv(k)
+
+    x = np.arange(width)
+    y = np.arange(height)
+    x, y = np.meshgrid(x, y)
+    z = np.ones_like(x)
+    xyz = np.concatenate([x[..., None], y[..., None], z[..., None]], axis=-1)
+    xyz = xyz @ k_inv.T
+    xyz.setflags(write=False)
+
+    return xyz
+
+
 class PanoVisualizer:
-    _HEIGHT: int = None
-    _WIDTH: int = None
-    _PANO: ndarray = None
-    _HEADING: float = None
+    # pano and heading are kept per thread, so that concurrent episodes do not overwrite each other.
+    _STATE = threading.local()
 
     _IMAGE_STORE: str = os.getenv("IMAGE_STORE")
     _PANO_MODE: str = os.getenv("PANO_MODE")
 
+    # yaw-free remap grids per perspective and pano shape, the heading only shifts them horizontally.
+    _REMAP_CACHE_SIZE: int = int(os.getenv("REMAP_CACHE_SIZE", 8))
+    _REMAP_CACHE: OrderedDict = OrderedDict()
+    _REMAP_LOCK = threading.Lock()
+
     @classmethod
     @property
     def PANO(cls) -> ndarray:
-        return cls._PANO
+        if getattr(cls._STATE, "pano", None) is None and getattr(cls._STATE, "pending", None):
+            cls.set_pano(cls._STATE.pending)
+        return getattr(cls._STATE, "pano", None)
+
+    @classmethod
+    @property
+    def FILENAME(cls) -> str:
+        return getattr(cls._STATE, "filename", None)
+
+    @classmethod
+    @property
+    def HEADING(cls) -> float:
+        return getattr(cls._STATE, "heading", None)
+
+    @classmethod
+    def select_pano(cls, image: str, heading: float):
+        """
+        remember the pano of the current viewpoint, it is only read from disk once its pixels are needed.
+        """
+        cls._STATE.filename = image
+        cls._STATE.pending = image
+        cls._STATE.pano = None
+        cls.set_heading(heading)
 
     @classmethod
     def set_pano(cls, image: str):
+        cls._STATE.filename = image
+        cls._STATE.pending = None
         if not Path(image).is_absolute():
             image = (Path(cls._IMAGE_STORE) / image).as_posix()
-        cls._PANO = cv2.cvtColor(
+        cls._STATE.pano = cv2.cvtColor(
             cv2.imread(image, cv2.IMREAD_COLOR),
             cv2.COLOR_BGR2RGB
         )  # R G B
-        cls._HEIGHT, cls._WIDTH = cls._PANO.shape[:2]
 
     @classmethod
     def set_heading(cls, heading):
         if cls._PANO_MODE == "google":
-            cls._HEADING = heading
+            cls._STATE.heading = heading
         else:
-            cls._HEADING = heading - 90
+            cls._STATE.heading = heading - 90
 
     @classmethod
-    def _plot_view(cls, xy: ndarray) -> ndarray:
-        overlay = cls._PANO.copy()
-        if abs((xy[0, -1] - xy[0, 0])[0].item()) > cls._WIDTH / 2:
+    def _plot_view(cls, pano: ndarray, xy: ndarray) -> ndarray:
+        overlay = pano.copy()
+        width = overlay.shape[1]
+        if abs((xy[0, -1] - xy[0, 0])[0].item()) > width / 2:
             corners1 = np.array([
                 [0, xy[0, -1][1].item()],
                 xy[0, -1],
@@ -77,10 +134,10 @@ class PanoVisualizer:
             ], np.int32)
 
             corners2 = np.array([
-                [cls._WIDTH, xy[0, 1][1].item()],
+                [width, xy[0, 1][1].item()],
                 xy[0, 0],
                 xy[-1, 0],
-                [cls._WIDTH, xy[-1, 0][1].item()]
+                [width, xy[-1, 0][1].item()]
             ], np.int32)
 
             cv2.polylines(overlay, [corners1, corners2], isClosed=True, color=(0, 255, 0), thickness=20)
@@ -96,6 +153,58 @@ class PanoVisualizer:
 
         return overlay
 
+    @classmethod
+    def _base_grid(cls,
+                   fov: int,
+                   phi: int,
+                   height: int,
+                   width: int,
+                   shape: Tuple[int, int]) -> Tuple[ndarray, ndarray]:
+        """
+        remap grid of a perspective looking at longitude 0.
+        """
+        key = (phi, fov, height, width, shape[0], shape[1])
+        with cls._REMAP_LOCK:
+            if key in cls._REMAP_CACHE:
+                cls._REMAP_CACHE.move_to_end(key)
+                return cls._REMAP_CACHE[key]
+
+        x_axis = np.array([1.0, 0.0, 0.0], np.float32)
+        r, _ = cv2.Rodrigues(x_axis * np.radians(phi))
+        xyz = ray_grid(fov, height, width) @ r.T
+        lonlat = xyz_to_lonlat(xyz)
+        xy = lonlat_to_xy(lonlat, shape=shape).astype(np.float32)
+        grid = (np.ascontiguousarray(xy[..., 0]), np.ascontiguousarray(xy[..., 1]))
+        for axis in grid:
+            axis.setflags(write=False)
+
+        with cls._REMAP_LOCK:
+            cls._REMAP_CACHE[key] = grid
+            while len(cls._REMAP_CACHE) > cls._REMAP_CACHE_SIZE:
+                cls._REMAP_CACHE.popitem(last=False)
+
+        return grid
+
+    @classmethod
+    def _remap_grid(cls,
+                    fov: int,
+                    theta: float,
+                    phi: int,
+                    height: int,
+                    width: int,
+                    shape: Tuple[int, int]) -> Tuple[ndarray, ndarray]:
+        """
+        the camera is pitched by phi then turned by theta around the vertical axis, and turning around the
+        vertical axis adds the same angle to every longitude: the grid is the cached one at longitude 0,
+        shifted by theta and wrapped. It matches the direct computation up to float32 rounding (< 0.001 px), so
+        no angle is quantized and a handful of grids serve every heading.
+        """
+        map_x, map_y = cls._base_grid(fov, phi, height, width, shape)
+        period = shape[1] - 1  # longitudes -pi..pi span the columns 0..width - 1
+        shift = np.float32(((theta - cls.HEADING) % 360) / 360 * period)
+
+        return np.mod(map_x + shift, np.float32(period)), map_y
+
     @classmethod
     def get_perspective(cls,
                         fov: int = 120,
@@ -111,35 +220,14 @@ class PanoVisualizer:
         :param width:
         :return:
         """
+        map_x, map_y = cls._remap_grid(fov, theta, phi, height, width, shape=cls.PANO.shape[:2])
+        perspective = cv2.remap(cls.PANO, map_x, map_y, cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP)
 
-        f = 0.5 * width * 1 / np.tan(0.5 * fov / 180.0 * np.pi)
-        cx = (width - 1) / 2.0
-        cy = (height - 1) / 2.0
-        k = np.array([
-            [f, 0, cx],
-            [0, f, cy],
-            [0, 0, 1],
-        ], np.float32)
-        k_inv = np.linalg.inv(k)
-
-        x = np.arange(width)
-        y = np.arange(height)
-        x, y = np.meshgrid(x, y)
-        z = np.ones_like(x)
-        xyz = np.concatenate([x[..., None], y[..., None], z[..., None]], axis=-1)
-        xyz = xyz @ k_inv.T
-
-        y_axis = np.array([0.0, 1.0, 0.0], np.float32)
-        x_axis = np.array([1.0, 0.0, 0.0], np.float32)
-        r1, _ = cv2.Rodrigues(y_axis * np.radians(theta - cls._HEADING))
-        r2, _ = cv2.Rodrigues(np.dot(r1, x_axis) * np.radians(phi))
-        r = r2 @ r1
-        xyz = xyz @ r.T
-        lonlat = xyz_to_lonlat(xyz)
-        xy = lonlat_to_xy(lonlat, shape=cls._PANO.shape).astype(np.float32)
-        perspective = cv2.remap(cls._PANO, xy[..., 0], xy[..., 1], cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP)
+        # only the border points of the grid are needed to outline the view, the overlay itself is drawn lazily.
+        rows, cols = np.ix_([0, -1], [0, 1, -1])
+        xy = np.stack([map_x[rows, cols], map_y[rows, cols]], axis=-1)
 
         return PanoItem(
             perspective,
-            cls._plot_view(xy)
-        )
\ No newline at end of file
+            partial(cls._plot_view, cls.PANO, xy)
+        )
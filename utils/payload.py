@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import os
+import cv2
+import base64
+import hashlib
+import threading
+import numpy as np
+
+from numpy import ndarray
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from typing import Dict, Optional, Tuple, List, TYPE_CHECKING
+
+from utils.operation import image_to_base64
+
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+
+# per `MultiModels` entry, the others send full size images. Small models spend most of their prefill on pixels.
+_POLICIES: Dict[str, dict] = {
+    "MiniCPM_V_2_6": dict(width=768, height=384, pano_width=1024, quality=85, max_request_bytes=1_000_000),
+    "Phi_3_5_vision_instruct": dict(width=768, height=384, pano_width=1024, quality=85, max_request_bytes=1_000_000),
+}
+
+
+@dataclass
+class PayloadPolicy:
+    """
+    Size of the images sent to a model: perspective resolution, pano width, JPEG quality and a budget in bytes
+    of base64 images per request. The resolution and quality are part of the encoded image cache keys.
+    """
+    width: int = 1024
+    height: int = 512
+    pano_width: Optional[int] = None  # None keeps the pano at its stored resolution
+    quality: int = 95
+    max_request_bytes: Optional[int] = None
+    # fitted requests by digest of their images, a step revisiting a node does not decode and encode again.
+    fit_cache_size: int = 64
+    _fitted: OrderedDict = field(default_factory=OrderedDict, init=False, repr=False, compare=False)
+    _fitted_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
+    @classmethod
+    def for_agent(cls, name: str) -> PayloadPolicy:
+        """
+        policy of a `MultiModels` entry, overridden by PAYLOAD_WIDTH, PAYLOAD_HEIGHT, PAYLOAD_PANO_WIDTH,
+        PAYLOAD_QUALITY and PAYLOAD_MAX_BYTES, or for one agent by the same variable suffixed with its name.
+        """
+        policy = cls(**_POLICIES.get(name, {}))
+        overrides = {}
+        for attribute, variable in (("width", "PAYLOAD_WIDTH"), ("height", "PAYLOAD_HEIGHT"),
+                                ("pano_width", "PAYLOAD_PANO_WIDTH"), ("quality", "PAYLOAD_QUALITY"),
+                                ("max_request_bytes", "PAYLOAD_MAX_BYTES")):
+            value = os.getenv(f"{variable}_{name}", os.getenv(variable))
+            if value not in (None, ""):
+                # 0 lifts the optional limits.
+                overrides[attribute] = ((int(value) or None) if attribute in ("pano_width", "max_request_bytes")
+                                        else int(value))
+
+        return replace(policy, **overrides)
+
+    def perspective_params(self, params: dict) -> dict:
+        return {**params, "width": self.width, "height": self.height}
+
+    @property
+    def pano_params(self) -> dict:
+        """
+        cache key parameters of the pano, empty at the stored resolution so existing keys stay valid.
+        """
+        return {} if self.pano_width is None else {"width": self.pano_width}
+
+    @classmethod
+    def resize(cls, image: ndarray, width: Optional[int]) -> ndarray:
+        if width is None or width >= image.shape[1]:
+            return image
+        height = max(round(image.shape[0] * width / image.shape[1]), 1)
+
+        return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+    def fit(self, images: Dict[str, str]) -> Dict[str, str]:
+        """
+        downscale the encoded images of one request until they fit in `max_request_bytes`.
+        JPEG size is roughly proportional to the pixel count, so each pass scales both sides by the square root
+        of the overshoot. The result is memoized by the digest of the input images.
+        """
+        total = sum(len(url) for url in images.values())
+        if self.max_request_bytes is None or total <= self.max_request_bytes:
+            return images
+
+        digest = hashlib.sha1()
+        for key, url in images.items():
+            digest.update(f"{key}\0{len(url)}\0".encode("utf-8"))
+            digest.update(url.encode("ascii"))
+        digest = digest.hexdigest()
+        with self._fitted_lock:
+            if digest in self._fitted:
+                self._fitted.move_to_end(digest)
+                return self._fitted[digest]
+
+        fitted = self._fit(images, total)
+        with self._fitted_lock:
+            self._fitted[digest] = fitted
+            while len(self._fitted) > self.fit_cache_size:
+                self._fitted.popitem(last=False)
+
+        return fitted
+
+    def _fit(self, images: Dict[str, str], total: int) -> Dict[str, str]:
+        from utils.map_logger import logger
+
+        fitted = images
+        for _ in range(3):
+            scale = 0.95 * (self.max_request_bytes / total) ** 0.5
+            decoded = {
+                key: cv2.imdecode(np.frombuffer(base64.b64decode(url.split(",", 1)[1]), np.uint8), cv2.IMREAD_COLOR)
+                for key, url in fitted.items()
+            }
+            fitted = {
+                key: image_to_base64(self.resize(image, max(int(image.shape[1] * scale), 1)), quality=self.quality)
+                for key, image in decoded.items()
+            }
+            fitted_total = sum(len(url) for url in fitted.values())
+            logger.info(f"Request images downscaled by {scale:.2f}: {total / 1024:.0f} KB -> {fitted_total / 1024:.0f} KB.")
+            total = fitted_total
+            if total <= self.max_request_bytes:
+                break
+
+        return fitted
+
+    @classmethod
+    def request_size(cls, messages: List[BaseMessage]) -> Tuple[int, int]:
+        """
+        number of images and characters of text plus base64 images in a request.
+        """
+        images, size = 0, 0
+        for message in messages:
+            parts = [message.content] if isinstance(message.content, str) else message.content
+            for part in parts:
+                if isinstance(part, str):
+                    size += len(part)
+                elif part.get("type") == "image_url":
+                    images += 1
+                    url = part["image_url"]["url"] if isinstance(part["image_url"], dict) else part["image_url"]
+                    size += len(url)
+                else:
+                    size += len(part.get("text", ""))
+
+        return images, size
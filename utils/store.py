@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import os
+import json
+import mmap
+
+from pathlib import Path
+from typing import Optional, Dict, Tuple, List, Union, Iterable
+
+from utils.cache import EncodedImageCache
+
+
+class PerspectiveStore:
+    """
+    Packed JPEGs of every perspective (and pano) of one city, rendered ahead of time by `precompute.py`.
+
+    <root>/images.bin   concatenated JPEG bytes
+    <root>/index.jsonl  one {"key", "offset", "length"} line per image, appended after its bytes are written
+    <root>/meta.json    pano params and JPEG quality used for rendering
+
+    Keys are the same content hashes as `EncodedImageCache.make_key`.
+    """
+
+    _IMAGES = "images.bin"
+    _INDEX = "index.jsonl"
+    _META = "meta.json"
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.index: Dict[str, Tuple[int, int]] = self._read_index(self.root / self._INDEX)
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+
+        images = self.root / self._IMAGES
+        if images.exists() and images.stat().st_size > 0:
+            self._file = open(images, mode="rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def from_env(cls) -> Optional[PerspectiveStore]:
+        """
+        PERSPECTIVE_STORE points to the directory holding one sub-directory per city.
+        """
+        store_dir = os.getenv("PERSPECTIVE_STORE")
+        if not store_dir:
+            return None
+        root = Path(store_dir) / os.getenv("CITY_NAME", "default")
+        if not (root / cls._INDEX).exists():
+            return None
+
+        return cls(root)
+
+    @classmethod
+    def _read_index(cls, path: Path) -> Dict[str, Tuple[int, int]]:
+        index = {}
+        if not path.exists():
+            return index
+        with open(path, mode="r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # the last line of an interrupted run
+                index[entry["key"]] = (entry["offset"], entry["length"])
+
+        return index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def get(self, key: str) -> Optional[bytes]:
+        if self._mmap is None or key not in self.index:
+            return None
+        offset, length = self.index[key]
+        if offset + length > len(self._mmap):
+            return None
+
+        return self._mmap[offset: offset + length]
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap, self._file = None, None
+
+
+class PerspectiveStoreWriter:
+    """
+    Append-only writer of a `PerspectiveStore`. Reopening an existing store resumes it: bytes written
+    after the last complete index line are dropped and already indexed keys can be skipped.
+    """
+
+    def __init__(self, root: Union[str, Path], params: dict, quality: int, sync_every: int = 256):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.sync_every = sync_every
+
+        meta = {"params": params, "quality": quality}
+        meta_file = self.root / PerspectiveStore._META
+        if meta_file.exists():
+            with open(meta_file, mode="r", encoding="utf-8") as f:
+                if json.load(f) != meta:
+                    raise ValueError(f"{self.root} was rendered with other parameters, use another directory.")
+        else:
+            with open(meta_file, mode="w", encoding="utf-8") as f:
+                json.dump(meta, f, indent=4)
+
+        index_file = self.root / PerspectiveStore._INDEX
+        self.index = PerspectiveStore._read_index(index_file)
+        end = max((offset + length for offset, length in self.index.values()), default=0)
+
+        # rewrite the index without a possibly truncated last line, and cut the unindexed tail of the pack.
+        with open(index_file, mode="w", encoding="utf-8") as f:
+            for key, (offset, length) in self.index.items():
+                f.write(json.dumps({"key": key, "offset": offset, "length": length}) + "\n")
+        self._images = open(self.root / PerspectiveStore._IMAGES, mode="ab")
+        self._images.truncate(end)
+        self._images.seek(end)
+        self._index = open(index_file, mode="a", encoding="utf-8")
+        self._offset = end
+        self._unsynced = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def write(self, items: Iterable[Tuple[str, bytes]]) -> None:
+        entries = []
+        for key, buffer in items:
+            self._images.write(buffer)
+            entries.append((key, self._offset, len(buffer)))
+            self._offset += len(buffer)
+        self._images.flush()
+
+        for key, offset, length in entries:
+            self.index[key] = (offset, length)
+            self._index.write(json.dumps({"key": key, "offset": offset, "length": length}) + "\n")
+        self._index.flush()
+
+        self._unsynced += len(entries)
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        os.fsync(self._images.fileno())
+        os.fsync(self._index.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        self.sync()
+        self._images.close()
+        self._index.close()
+
+
+def render_viewpoint(filename: str,
+                     heading: float,
+                     walkable_headings: List[float],
+                     params: dict,
+                     quality: int,
+                     include_pano: bool = True,
+                     skip: Tuple[str, ...] = (),
+                     pano_params: Optional[dict] = None) -> List[Tuple[str, bytes]]:
+    """
+    render and JPEG-encode every walkable perspective of one viewpoint, used by the worker processes of
+    `precompute.py`. Keys listed in `skip` are not rendered again.
+
+    :param pano_params: `PayloadPolicy.pano_params`, the pano is stored at its own resolution by default
+    """
+    from utils.panovis import PanoVisualizer
+    from utils.payload import PayloadPolicy
+    from utils.operation import image_to_jpeg
+
+    PanoVisualizer.select_pano(filename, heading)
+    rendered = []
+    pano_params = pano_params or {}
+
+    key = EncodedImageCache.make_key(filename, None, pano_params, quality)
+    if include_pano and key not in skip:
+        pano = PayloadPolicy.resize(PanoVisualizer.PANO, pano_params.get("width"))
+        rendered.append((key, image_to_jpeg(pano, quality=quality)))
+
+    for walkable_heading in walkable_headings:
+        key = EncodedImageCache.make_key(filename, walkable_heading, params, quality)
+        if key not in skip:
+            perspective = PanoVisualizer.get_perspective(theta=walkable_heading, **params).perspective
+            rendered.append((key, image_to_jpeg(perspective, quality=quality)))
+
+    return rendered